@@ -26,4 +26,4 @@
 The elections module contains all of the classes and functions for
 working with elections.
 '''
-__all__ = ['blt', 'condorcet', 'election', 'irv', 'node']
+__all__ = ['blt', 'cache', 'compact', 'condorcet', 'dense', 'election', 'ilp', 'irv', 'node', 'tally']
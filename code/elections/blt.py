@@ -24,109 +24,288 @@
 
 '''
 This module contains functions for reading and writing .blt files.
+
+Files whose names end in C{.gz}, C{.bz2}, or C{.xz} are compressed and
+decompressed on the fly. Reading C{.xz} files requires the C{lzma} module.
 '''
 
-import cPickle
+import bz2
+import gzip
+import hashlib
+import itertools
+import multiprocessing
 import os
-import re
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+import cache
 from node import Node
 from election import Election
 
-# So little error checking!
-def _read_blt(path):
-    '''Parse a .blt file and return the L{Election}.
+# Bump this whenever the result of parsing a .blt changes so that cached
+# elections are not used.
+PARSER_VERSION = 1
+
+def _open(path, mode='r'):
+    '''Open a possibly compressed .blt file.
+
+    Files ending in C{.gz}, C{.bz2}, or C{.xz} are compressed or decompressed
+    on the fly. Other files are opened normally.
 
     @type  path: string
     @param path: File path.
+    @type  mode: string
+    @param mode: C{'r'} or C{'w'}.
+    @rtype: file
+    @return: Returns a file-like object.
+    '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, mode)
+    if path.endswith('.xz'):
+        if lzma is None:
+            raise Exception('Cannot open %s because the lzma module could not be loaded.' % path)
+        return lzma.LZMAFile(path, mode + 'b')
+    return open(path, mode)
+
+def _clean_ballot(choices):
+    '''Apply the ballot cleaning rules to the choices on a ballot.
+
+    Skipped ranks (C{-}) are ignored, an overvote (C{=}) ends the ballot, and
+    only the first occurrence of each candidate counts.
+
+    @type  choices: list
+    @param choices: The ranked choices as strings.
+    @rtype: list
+    @return: Returns the list of candidates in order of preference.
+    '''
+    ballot = []
+    for c in choices:
+        if c == '-':
+            continue
+        if '=' in c:
+            break
+        c = int(c)
+        if c not in ballot:
+            ballot.append(c)
+    return ballot
+
+def _split_ballot(line):
+    '''Split a ballot line into its weight and the choices ranked on it.
+
+    @type  line: string
+    @param line: A ballot line of the form C{w c1 c2 ... 0}, optionally
+    preceded by a parenthesized ballot identifier.
+    @rtype: number, list
+    @return: Returns the weight and the ranked choices as strings.
+    @raise Exception: If C{line} is not a ballot line.
+    '''
+    choices = line.split()
+    if choices and choices[0][0] == '(':
+        # Strip the optional ballot identifier
+        while not choices[0].endswith(')'):
+            choices.pop(0)
+        choices.pop(0)
+    if len(choices) < 2 or not choices[0].isdigit() or choices[-1] != '0':
+        raise Exception('Expected 0 after ballots "%s"' % line)
+    return (int(choices[0]), choices[1:-1])
+
+# So little error checking!
+def _parse_blt(data):
+    '''Parse the contents of a .blt file and return the L{Election}.
+
+    The contents are split into lines at once and each distinct ballot line is
+    parsed only once, no matter how many voters cast it. A ballot line with
+    weight C{w} counts as C{w} identical ballots.
+
+    @type  data: string
+    @param data: The contents of the .blt file.
     @rtype: L{Election}
     @return: Returns the L{Election}.
     '''
-    f = open(path)
+    lines = data.split('\n')
     # Skip over leading comments
-    while True:
-        line = f.readline()
-        if len(line) == 0:
-            raise Exception('Invalid blt')
-        if len(line) and line[0] != '#':
-            break
+    i = 0
+    while i < len(lines) and lines[i][:1] == '#':
+        i += 1
+    if i == len(lines) or len(lines[i]) == 0:
+        raise Exception('Invalid blt')
 
     # Get the number of candidates and seats
-    num_candidates, seats = [int(x) for x in line.split()]
+    num_candidates, seats = [int(x) for x in lines[i].split()]
+    start = i+1
+    try:
+        end = lines.index('0', start)
+    except ValueError:
+        raise Exception('Expected 0 after ballots')
+
+    # Count the distinct ballot lines
+    counts = {}
+    get = counts.get
+    for line in itertools.islice(lines, start, end):
+        counts[line] = get(line, 0) + 1
+
     root = Node()
     ranks = 0
     # Make sure the root has a child for every candidate
     for c in xrange(1, num_candidates+1):
         root.get_child(c)
     num_ballots = 0
-    while True:
-        line = f.readline()
-        m = re.match(r'(\(.*?\) )?1 ([-=0-9 ]*)0', line)
-        if not m:
-            break
-        num_ballots += 1
-        choices = m.group(2).split()
+    for line, num in counts.iteritems():
+        weight, choices = _split_ballot(line)
         ranks = max(ranks, len(choices))
-        seen = set()
+        num *= weight
+        num_ballots += num
         curr = root
-        for c in choices:
-            if c == '-':
-                continue
-            if '=' in c:
-                break
-            c = int(c)
-            if c not in seen:
-                seen.add(c)
-                curr = curr.get_child(c)
-                curr.value += 1
-
-    if line != '0\n':
-        raise Exception( 'Expected 0 after ballots "%s"' % line )
+        for c in _clean_ballot(choices):
+            curr = curr.get_child(c)
+            curr.value += num
 
     names = dict()
     for c in xrange(1, num_candidates+1):
-        names[c] = f.readline()[1:-2]
-    description = f.readline()[1:-2]
-    f.close()
+        names[c] = lines[end+c][1:-1]
+    description = lines[end+num_candidates+1][1:-1]
     root.value = num_ballots
     return Election(names=names, profile=root, ranks=ranks, seats=seats, description=description)
 
-def read_blt(path):
+def _read_blt(path):
+    '''Parse a .blt file and return the L{Election}.
+
+    @type  path: string
+    @param path: File path.
+    @rtype: L{Election}
+    @return: Returns the L{Election}.
+    '''
+    f = _open(path)
+    data = f.read()
+    f.close()
+    return _parse_blt(data)
+
+def _file_name(path):
+    '''Return a name for the .blt that changes whenever its path, inode, size
+    or modification time, or L{PARSER_VERSION}, does.'''
+    st = os.stat(path)
+    return hashlib.sha1('%s\0%d\0%d\0%r\0%d' % (os.path.abspath(path),
+                        st.st_ino, st.st_size, st.st_mtime,
+                        PARSER_VERSION)).hexdigest()
+
+def read_blt(path, cache_dir=None):
     '''Parse a .blt file or use a cached version and return an L{Election} instance.
 
-    If the file is 'foo/bar.blt', check for the existence of 'foo/bar.pickle'.
-    If it exists and it is newer than the .blt, use that. Otherwise, parse the
-    .blt and update the .pickle.
+    Parsed elections are cached in C{cache_dir} keyed by the SHA-1 hash of the
+    decompressed contents of the .blt and L{PARSER_VERSION}, so copies of the
+    same election share one entry whatever their names or compression, and
+    the directory holding the .blt is never written to. The key is also
+    stored under a name computed from the path, inode, size and modification
+    time of the file, so a file that has not changed since it was last read
+    is found in the cache without being read or hashed. See L{cache} for how
+    the cache directory is managed.
 
     @type  path: string
     @param path: Path to the .blt.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{cache.CACHE_DIR}.
     @rtype: L{Election}
     @return: An L{Election} representing the ballots at C{path}.
     '''
-    name, _ = os.path.splitext(path)
-    cached = name + '.pickle'
-    t1 = os.path.getmtime(path)
-    try:
-        t2 = os.path.getmtime(cached)
-    except os.error:
-        t2 = -1
-    election = None
-    if t2 >= t1:
-        f = open(cached)
-        election = cPickle.load(f)
-        f.close()
-        # Ensure the versions match
-        if election.version != Election.VERSION:
-            election = None
+    name = _file_name(path)
+    key = cache.get_key(name, cache_dir)
+    if key is not None:
+        election = cache.get(key, cache_dir)
+        if election is not None:
+            return election
+    f = _open(path)
+    data = f.read()
+    f.close()
+    key = '%s-%d' % (hashlib.sha1(data).hexdigest(), PARSER_VERSION)
+    election = cache.get(key, cache_dir)
     if election is None:
         # Parse it and cache it
-        election = _read_blt(path)
-        f = open(cached, 'w')
-        cPickle.dump(election, f, -1)
-        f.close()
+        election = _parse_blt(data)
+        cache.put(key, election, cache_dir)
+    cache.put_key(name, key, cache_dir)
     return election
 
-def _write_blt(f, root, ranks, b):
+def _load_election(args):
+    '''Load an election in a worker process for L{load_corpus}.
+
+    The election is returned in the compact L{cache} format which is much
+    cheaper to send back to the parent than a pickled profile tree.
+    '''
+    path, cache_dir = args
+    return (path, cache.dumps(read_blt(path, cache_dir)))
+
+def load_corpus(paths, jobs=None, cache_dir=None):
+    '''Load many .blt files in parallel and iterate over the elections.
+
+    Each file is parsed, or loaded from the cache, by L{read_blt} in a pool of
+    worker processes. The largest files are started first so that the total
+    time is close to the time to load the largest file.
+
+    @type  paths: list
+    @param paths: Paths to the .blt files.
+    @type  jobs: number
+    @param jobs: The number of worker processes. If C{None}, use one per CPU.
+    If 1, load the files in this process.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{cache.CACHE_DIR}.
+    @rtype: iterator
+    @return: Returns an iterator over C{(path, election)} pairs in the order
+    in which the elections finish loading.
+    '''
+    paths = sorted(paths, key=os.path.getsize, reverse=True)
+    if jobs == 1:
+        for path in paths:
+            yield (path, read_blt(path, cache_dir))
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        results = pool.imap_unordered(_load_election,
+                                      [(path, cache_dir) for path in paths])
+        for path, data in results:
+            yield (path, cache.loads(data))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def iter_ballots(path):
+    '''Iterate over the cleaned ballots in a .blt file.
+
+    Unlike L{read_blt}, the file is read one line at a time and no profile is
+    built, so arbitrarily large files can be processed in bounded memory. The
+    ballots are cleaned using the same rules as L{read_blt}.
+
+    @type  path: string
+    @param path: Path to the .blt.
+    @rtype: iterator
+    @return: Returns an iterator over C{(ballot, weight)} pairs where
+    C{ballot} is a tuple of candidates in order of preference.
+    '''
+    f = _open(path)
+    try:
+        # Skip over leading comments and the candidates and seats line
+        for line in f:
+            if line[0] != '#':
+                break
+        for line in f:
+            line = line.rstrip('\n')
+            if line == '0':
+                return
+            weight, choices = _split_ballot(line)
+            yield (tuple(_clean_ballot(choices)), weight)
+        raise Exception('Expected 0 after ballots')
+    finally:
+        f.close()
+
+def _write_blt(f, root, ranks, b, compact):
     '''Write the node root to f.
     
     @type  f: file
@@ -137,33 +316,43 @@ def _write_blt(f, root, ranks, b):
     @param ranks: The number of candidates the voter was allowed to rank.
     @type  b: list
     @param b: List of candidates ranked ahead the children in the subtree.
+    @type  compact: boolean
+    @param compact: If C{True}, write each distinct ballot once with its
+    count as the weight.
     '''
     num = 0
     for c, n in root.iterchildren():
         num += n.value
         b.append(c)
-        _write_blt(f, n, ranks, b)
+        _write_blt(f, n, ranks, b, compact)
         b.pop()
     if root.value > num:
-        line = '1'
+        line = ''
         for c in b:
             line += ' %d' % c
         if len(b) < ranks:
             line += ' -' * (ranks-len(b))
         line += ' 0\n'
-        f.write(line * (root.value-num))
+        if compact:
+            f.write('%d%s' % (root.value-num, line))
+        else:
+            f.write(('1' + line) * (root.value-num))
 
-def write_blt(path, election):
+def write_blt(path, election, compact=False):
     '''Write a "simplified" .blt file from the election.
     
     @type  path: string
     @param path: The path to the .blt file to write.
     @type  election: L{Election}
     @param election: The election to write out.
+    @type  compact: boolean
+    @param compact: If C{True}, write each distinct ballot once using the
+    weight field for the number of voters who cast it rather than writing one
+    line per voter.
     '''
-    f = open(path, 'w')
+    f = _open(path, 'w')
     f.write('%d %d\n' % (len(election.names), election.seats))
-    _write_blt(f, election.profile, election.ranks, [])
+    _write_blt(f, election.profile, election.ranks, [], compact)
     f.write('0\n')
     for n in range(1, len(election.names)+1):
         f.write('"%s"\n' % election.names[n])
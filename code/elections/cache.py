@@ -0,0 +1,506 @@
+# Copyright (c) 2011, Stephen Checkoway <s@cs.ucsd.edu>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+This module contains functions for storing an L{Election} in a compact,
+versioned binary format.
+
+The profile is stored as a flattened tree: the nodes are listed in preorder
+and, for each node, the candidate, the value, and the number of children are
+stored in three parallel arrays. The candidate names and the description are
+stored as newline separated text. Loading a cached election is a single read
+followed by rebuilding the tree from the arrays.
+
+Cached elections are kept in a cache directory, named by a key computed by
+the caller, e.g., from a hash of the contents of the .blt. A caller can also
+store a key under a cheaper name with L{put_key}, so that it can find the
+election again without recomputing the key. When the total size of the
+cached elections and keys exceeds L{CACHE_SIZE}, the least recently used
+files are evicted. Files are written to a temporary file and renamed into
+place so that any number of processes can share the cache directory.
+
+The results of L{ilp.distance_to} are appended to a log in the same
+directory, keyed by the fingerprint of the reduced profile, the maximum
+number of ranks and the elimination order, so they are reused across runs.
+The log has its own limit, L{DISTANCE_LOG_SIZE}, and is not counted against
+L{CACHE_SIZE}.
+
+@sort: VERSION, CACHE_DIR, CACHE_SIZE, DISTANCE_LOG_SIZE, dumps, loads, dump,
+load, get, put, get_key, put_key, distance_key, get_distance, put_distance
+'''
+
+import array
+import hashlib
+import os
+import struct
+import tempfile
+
+from node import Node
+from election import Election
+
+# This should be incremented when the format changes
+VERSION = 1
+
+# The default cache directory, the size in bytes of the cached elections
+# and keys, and the size in bytes of the distance log
+CACHE_DIR = os.environ.get('ELECTIONS_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'elections'))
+CACHE_SIZE = int(os.environ.get('ELECTIONS_CACHE_SIZE', 64 << 20))
+DISTANCE_LOG_SIZE = int(os.environ.get('ELECTIONS_DISTANCE_LOG_SIZE', 16 << 20))
+
+_MAGIC = 'BLTC'
+_HEADER = struct.Struct('=4sIIIIIII')
+_BYTE_ORDER = 0x01020304
+
+def _flatten(node, c, candidates, values, num_children):
+    '''Append the subtree rooted at C{node} to the arrays in preorder.
+
+    @type  node: L{Node}
+    @param node: The root of the subtree.
+    @type  c: number
+    @param c: The candidate of C{node}.
+    @type  candidates: C{array.array}
+    @param candidates: The candidate of each node.
+    @type  values: C{array.array}
+    @param values: The value of each node.
+    @type  num_children: C{array.array}
+    @param num_children: The number of children of each node.
+    '''
+    candidates.append(c)
+    values.append(node.value)
+    num_children.append(node.num_children())
+    for child in sorted(node):
+        _flatten(node.get_child(child), child, candidates, values, num_children)
+
+def dumps(election):
+    '''Return the binary representation of the election.
+
+    @type  election: L{Election}
+    @param election: The election.
+    @rtype: string
+    @return: Returns the binary representation of C{election}.
+    '''
+    candidates = array.array('H')
+    values = array.array('i')
+    num_children = array.array('H')
+    _flatten(election.profile, 0, candidates, values, num_children)
+    names = [election.names[c] for c in sorted(election.names)]
+    text = '\n'.join(names + [election.description])
+    header = _HEADER.pack(_MAGIC, VERSION, _BYTE_ORDER, len(names),
+                          election.seats, election.ranks, len(values), len(text))
+    return ''.join((header, text, candidates.tostring(), values.tostring(),
+                    num_children.tostring()))
+
+def loads(data):
+    '''Return the election from its binary representation.
+
+    @type  data: string
+    @param data: The binary representation of an L{Election}.
+    @rtype: L{Election}
+    @return: Returns the L{Election} or C{None} if C{data} is not in the
+    current format.
+    '''
+    if len(data) < _HEADER.size:
+        return None
+    magic, version, byte_order, num_candidates, seats, ranks, num_nodes, \
+            text_len = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != VERSION or byte_order != _BYTE_ORDER:
+        return None
+    offset = _HEADER.size
+    text = data[offset:offset+text_len].split('\n')
+    offset += text_len
+    arrays = []
+    for typecode in 'HiH':
+        a = array.array(typecode)
+        end = offset + a.itemsize*num_nodes
+        if end > len(data):
+            return None
+        a.fromstring(data[offset:end])
+        arrays.append(a)
+        offset = end
+    candidates, values, num_children = arrays
+
+    # Rebuild the tree. The stack holds the children dictionaries of the
+    # nodes whose children have not all been read yet and how many remain.
+    root = Node(values[0])
+    # pylint: disable=W0212
+    stack = [(root._children, num_children[0])]
+    for i in xrange(1, num_nodes):
+        children, remaining = stack.pop()
+        while remaining == 0:
+            children, remaining = stack.pop()
+        stack.append((children, remaining-1))
+        node = Node(values[i])
+        children[candidates[i]] = node
+        if num_children[i]:
+            stack.append((node._children, num_children[i]))
+    # pylint: enable=W0212
+
+    names = dict(zip(xrange(1, num_candidates+1), text[:num_candidates]))
+    return Election(names=names, profile=root, ranks=ranks, seats=seats,
+                    description=text[num_candidates])
+
+def dump(path, election):
+    '''Write the binary representation of the election to a file.
+
+    @type  path: string
+    @param path: The path to the file to write.
+    @type  election: L{Election}
+    @param election: The election.
+    '''
+    f = open(path, 'wb')
+    f.write(dumps(election))
+    f.close()
+
+def load(path):
+    '''Read an election from a file written by L{dump}.
+
+    @type  path: string
+    @param path: The path to the file to read.
+    @rtype: L{Election}
+    @return: Returns the L{Election} or C{None} if the file is not in the
+    current format.
+    '''
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    return loads(data)
+
+def _cache_path(key, cache_dir):
+    '''Return the path of the cache file for the key.'''
+    return os.path.join(cache_dir, '%s-%d.bltc' % (key, VERSION))
+
+def _key_path(name, cache_dir):
+    '''Return the path of the file holding the key stored under the name.'''
+    return os.path.join(cache_dir, '%s-%d.key' % (name, VERSION))
+
+def _touch(path):
+    '''Mark a cache file as recently used.'''
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+def get(key, cache_dir=None):
+    '''Return the cached election for the key, if any.
+
+    @type  key: string
+    @param key: The cache key.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{CACHE_DIR}.
+    @rtype: L{Election}
+    @return: Returns the L{Election} or C{None} if it is not in the cache.
+    '''
+    path = _cache_path(key, cache_dir or CACHE_DIR)
+    try:
+        election = load(path)
+    except IOError:
+        return None
+    _touch(path)
+    return election
+
+def put(key, election, cache_dir=None, max_size=None):
+    '''Add the election to the cache and evict old entries.
+
+    Failing to write to the cache, e.g., because it is on a read-only
+    file system, is not an error.
+
+    @type  key: string
+    @param key: The cache key.
+    @type  election: L{Election}
+    @param election: The election.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{CACHE_DIR}.
+    @type  max_size: number
+    @param max_size: The maximum size of the cache in bytes. If C{None}, use
+    L{CACHE_SIZE}.
+    @rtype: boolean
+    @return: Returns C{True} if the election was written to the cache.
+    '''
+    cache_dir = cache_dir or CACHE_DIR
+    return _write(_cache_path(key, cache_dir), dumps(election), cache_dir,
+                  max_size)
+
+def get_key(name, cache_dir=None):
+    '''Return the key stored under the name, if any.
+
+    @type  name: string
+    @param name: The name passed to L{put_key}.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{CACHE_DIR}.
+    @rtype: string
+    @return: Returns the key or C{None} if it is not in the cache.
+    '''
+    path = _key_path(name, cache_dir or CACHE_DIR)
+    try:
+        f = open(path, 'rb')
+        try:
+            key = f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+    if not key:
+        return None
+    _touch(path)
+    return key
+
+def put_key(name, key, cache_dir=None, max_size=None):
+    '''Store a key under a name and evict old entries.
+
+    Like L{put}, failing to write to the cache is not an error.
+
+    @type  name: string
+    @param name: The name.
+    @type  key: string
+    @param key: The cache key.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{CACHE_DIR}.
+    @type  max_size: number
+    @param max_size: The maximum size of the cache in bytes. If C{None}, use
+    L{CACHE_SIZE}.
+    @rtype: boolean
+    @return: Returns C{True} if the key was written to the cache.
+    '''
+    cache_dir = cache_dir or CACHE_DIR
+    return _write(_key_path(name, cache_dir), key, cache_dir, max_size)
+
+def distance_key(root, ranks, elim_order):
+    '''Return the cache key of a L{ilp.distance_to} problem.
+
+    @type  root: L{Node}
+    @param root: Root of the ballot tree, reduced modulo C{elim_order} with
+    L{Node.reduce}.
+    @type  ranks: number
+    @param ranks: The maximum number of candidates a voter can rank.
+    @type  elim_order: list
+    @param elim_order: The elimination order.
+    @rtype: string
+    @return: Returns the cache key.
+    '''
+    h = hashlib.sha1(root.fingerprint())
+    h.update('%d:%s' % (ranks, ','.join('%d' % c for c in elim_order)))
+    return h.hexdigest()
+
+# The distances loaded from the log of each cache directory
+_distances = {}
+
+def _distance_log(cache_dir):
+    '''Return the path of the distance log of the cache directory.'''
+    return os.path.join(cache_dir, 'distances-%d.log' % VERSION)
+
+def _add_distance(table, key, entry):
+    '''Add an entry to a distance table unless a better one is already there.
+
+    An optimal distance is better than a timeout and a timeout is better than
+    one with a shorter time limit.
+    '''
+    old = table.get(key)
+    if old is None or (old[0] == 'timeout' and
+                       (entry[0] == 'optimal' or entry[3] > old[3])):
+        table[key] = entry
+
+def _distance_table(cache_dir):
+    '''Return the table of distances in the cache directory, loading the log
+    the first time.
+
+    If the log has grown past L{DISTANCE_LOG_SIZE}, it is rewritten with the
+    most recently added distances that fit in half of it.
+    '''
+    table = _distances.get(cache_dir)
+    if table is not None:
+        return table
+    table = {}
+    _distances[cache_dir] = table
+    path = _distance_log(cache_dir)
+    try:
+        f = open(path, 'rb')
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+    except IOError:
+        return table
+    # The position in the log of the last entry for each key
+    last = {}
+    for i, line in enumerate(lines):
+        fields = line.split()
+        # Skip partially written lines
+        if len(fields) != 5 or not line.endswith('\n'):
+            continue
+        try:
+            entry = (fields[1],) + tuple(float(x) for x in fields[2:])
+        except ValueError:
+            continue
+        _add_distance(table, fields[0], entry)
+        last[fields[0]] = i
+    if sum(len(line) for line in lines) > DISTANCE_LOG_SIZE:
+        kept = []
+        size = 0
+        for key in sorted(last, key=last.get, reverse=True):
+            line = _distance_line(key, table[key])
+            size += len(line)
+            if size > DISTANCE_LOG_SIZE // 2:
+                break
+            kept.append(line)
+        kept.reverse()
+        _write(path, ''.join(kept), cache_dir, None)
+    return table
+
+def _distance_line(key, entry):
+    '''Return the line of the distance log for an entry.'''
+    return '%s %s %r %r %r\n' % ((key,) + entry)
+
+def get_distance(key, timeout, cache_dir=None):
+    '''Return the cached distance for the key, if any.
+
+    A distance that was not found because the solver ran out of time is only
+    returned if C{timeout} is no longer than the time the solver was given.
+
+    @type  key: string
+    @param key: The key from L{distance_key}.
+    @type  timeout: number
+    @param timeout: The time the solver would be given.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{CACHE_DIR}.
+    @rtype: number, number
+    @return: Returns the distance, or -1 on timeout, and the time in seconds
+    it took to compute or C{None} if it is not in the cache.
+    '''
+    entry = _distance_table(cache_dir or CACHE_DIR).get(key)
+    if entry is None:
+        return None
+    status, objective, seconds, limit = entry
+    if status == 'optimal':
+        return (objective, seconds)
+    if timeout <= limit:
+        return (-1, seconds)
+    return None
+
+def put_distance(key, distance, seconds, timeout, cache_dir=None):
+    '''Add a distance to the cache.
+
+    The distances are appended to a log in the cache directory. Each entry
+    is written with a single append, so any number of processes can add
+    entries at the same time.
+
+    @type  key: string
+    @param key: The key from L{distance_key}.
+    @type  distance: number
+    @param distance: The distance or -1 if the solver ran out of time.
+    @type  seconds: number
+    @param seconds: The time it took to compute the distance.
+    @type  timeout: number
+    @param timeout: The time the solver was given.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{CACHE_DIR}.
+    @rtype: boolean
+    @return: Returns C{True} if the distance was written to the cache.
+    '''
+    cache_dir = cache_dir or CACHE_DIR
+    if distance == -1:
+        status = 'timeout'
+    else:
+        status = 'optimal'
+    entry = (status, float(distance), float(seconds), float(timeout))
+    _add_distance(_distance_table(cache_dir), key, entry)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd = os.open(_distance_log(cache_dir),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    except OSError:
+        return False
+    try:
+        os.write(fd, _distance_line(key, entry))
+    except OSError:
+        return False
+    finally:
+        os.close(fd)
+    return True
+
+def _write(path, data, cache_dir, max_size):
+    '''Atomically write data to the cache file at path and evict old entries.
+
+    Failing to write to the cache is not an error.
+
+    @rtype: boolean
+    @return: Returns C{True} if the file was written.
+    '''
+    if max_size is None:
+        max_size = CACHE_SIZE
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=cache_dir)
+    except OSError:
+        return False
+    try:
+        f = os.fdopen(fd, 'wb')
+        f.write(data)
+        f.close()
+        # Renaming is atomic so readers see either no file or the whole file
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        return False
+    _evict(cache_dir, max_size)
+    return True
+
+def _evict(cache_dir, max_size):
+    '''Remove the least recently used files until the cache fits in max_size.
+
+    Other processes may be evicting files at the same time so files can
+    disappear at any point.
+    '''
+    entries = []
+    total = 0
+    try:
+        names = os.listdir(cache_dir)
+    except OSError:
+        return
+    for name in names:
+        if not name.endswith(('.bltc', '.key')):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total += st.st_size
+    entries.sort()
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+# vim: set sw=4 sts=4 tw=0 expandtab:
@@ -0,0 +1,105 @@
+# Copyright (c) 2011, Stephen Checkoway <s@cs.ucsd.edu>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+'''
+This module solves the integer-linear programs from L{ilp.Layout} and
+L{ilp.bounds} using the open-source CBC solver through PuLP. PuLP 1.6, the
+last release that supports Python 2, ships a CBC binary, so nothing else
+needs to be installed and no license is needed.
+
+PuLP writes the program to a file and runs CBC on it for every solve, so
+this is slower than L{cplex_ilp}, which keeps the program in memory.
+'''
+
+import pulp
+
+_SENSES = {'E': pulp.LpConstraintEQ, 'L': pulp.LpConstraintLE}
+
+def load(layout):
+    '''Build a program as a PuLP problem.
+
+    @type  layout: L{ilp.Layout}
+    @param layout: The program.
+    @rtype: dict
+    @return: Returns the state of the loaded program.
+    '''
+    prob = pulp.LpProblem('distance_to', pulp.LpMinimize)
+    variables = [pulp.LpVariable('x%d' % i, 0, None, pulp.LpInteger)
+                 for i in range(len(layout.obj))]
+    prob += pulp.LpAffineExpression(zip(variables, layout.obj.tolist()))
+    cols = layout.cols.tolist()
+    coefs = layout.coefs.tolist()
+    indptr = layout.indptr.tolist()
+    constraints = []
+    for i in range(layout.num_rows):
+        a, b = indptr[i], indptr[i+1]
+        expr = pulp.LpAffineExpression([(variables[c], coef) for c, coef
+                                        in zip(cols[a:b], coefs[a:b])])
+        prob += pulp.LpConstraint(expr, _SENSES[layout.senses[i]],
+                                  'c%d' % i, 0)
+        constraints.append(prob.constraints['c%d' % i])
+    return {'prob': prob, 'variables': variables, 'constraints': constraints}
+
+def update(state, ub, rhs):
+    '''Set the variable upper bounds and the right-hand sides of a loaded
+    program.
+
+    @type  state: dict
+    @param state: The state returned by L{load}.
+    @type  ub: C{numpy.ndarray}
+    @param ub: The upper bounds of the variables.
+    @type  rhs: C{numpy.ndarray}
+    @param rhs: The right-hand sides of the constraints.
+    '''
+    for variable, bound in zip(state['variables'], ub.tolist()):
+        variable.upBound = bound
+    for constraint, value in zip(state['constraints'], rhs.tolist()):
+        constraint.changeRHS(value)
+
+def solve(state, timeout, warm_start=False):
+    '''Solve a loaded program.
+
+    @type  state: dict
+    @param state: The state returned by L{load}.
+    @type  timeout: number
+    @param timeout: The computation timeout.
+    @type  warm_start: boolean
+    @param warm_start: Ignored. PuLP 1.6 cannot give CBC a starting
+    solution, so CBC starts from scratch every time.
+    @rtype: number
+    @return: Returns -1 on timeout. Otherwise, it returns the optimal
+    objective value.
+    @raise Exception: If CBC finds the program infeasible or unbounded or
+    fails.
+    '''
+    prob = state['prob']
+    status = prob.solve(pulp.PULP_CBC_CMD(msg=0, maxSeconds=timeout))
+    # CBC stops with LpStatusNotSolved when it runs out of time
+    if status == pulp.LpStatusNotSolved:
+        return -1
+    if status != pulp.LpStatusOptimal:
+        raise Exception('CBC could not solve the program: %s.'
+                        % pulp.LpStatus[status])
+    return pulp.value(prob.objective)
+
+# vim: set sw=4 sts=4 tw=0 expandtab:
@@ -0,0 +1,241 @@
+# Copyright (c) 2011, Stephen Checkoway <s@cs.ucsd.edu>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+This module contains the CompactProfile class, a read-only, array-backed
+alternative to a tree of L{Node}s.
+
+The nodes of the tree are stored in breadth-first order in parallel arrays,
+so the children of each node are contiguous and sorted by candidate. A node
+is identified by its index in the arrays, and L{CompactNode} provides the
+read-only part of the L{Node} interface on top of an index.
+
+@sort: CompactProfile, CompactNode
+'''
+
+import array
+
+class CompactNode(object):
+    '''A read-only view of one node of a L{CompactProfile}.
+
+    @type _profile: L{CompactProfile}
+    @ivar _profile: The profile containing the node.
+    @type _index: number
+    @ivar _index: The index of the node in the arrays of C{_profile}.
+    '''
+    __slots__ = ('_profile', '_index')
+
+    def __init__(self, profile, index):
+        '''Create a view of the node at C{index} in C{profile}.
+
+        @type  profile: L{CompactProfile}
+        @param profile: The profile containing the node.
+        @type  index: number
+        @param index: The index of the node.
+        '''
+        self._profile = profile
+        self._index = index
+
+    def __repr__(self):
+        '''Return a representation of self.
+
+        @rtype: string
+        @return: Returns a string representation of the node.
+        '''
+        return 'CompactNode(value=%d, children=%s)' % \
+                (self.value, repr(dict(self.iterchildren())))
+
+    @property
+    def value(self):
+        '''The value of the node, including the sum of the values of its
+        children.'''
+        return self._profile.count[self._index]
+
+    def _find(self, c):
+        '''Return the index of the child C{c} or -1 if there is none.'''
+        p = self._profile
+        lo = p.first_child[self._index]
+        end = hi = lo + p.child_count[self._index]
+        candidate = p.candidate
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if candidate[mid] < c:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < end and candidate[lo] == c:
+            return lo
+        return -1
+
+    def has_child(self, c):
+        '''Return C{True} if the node has a child with name C{c}.
+
+        @type  c: number
+        @param c: The child.
+        @rtype: boolean
+        @return: Returns C{True} if the node has a child with name C{c}.
+        '''
+        return self._find(c) >= 0
+
+    def get_child(self, c):
+        '''Return the child node.
+
+        Unlike L{Node.get_child}, the child is not created if it does not
+        exist.
+
+        @type  c: number
+        @param c: The child.
+        @rtype: L{CompactNode}
+        @return: Returns the child node.
+        @raise KeyError: If there is no child C{c}.
+        '''
+        i = self._find(c)
+        if i < 0:
+            raise KeyError(c)
+        return CompactNode(self._profile, i)
+
+    def children(self):
+        '''Return a set of children names.
+
+        @rtype: set
+        @return: Returns the set of children.
+        '''
+        return set(self)
+
+    def num_children(self):
+        '''Return the number of children.
+
+        @rtype: number
+        @return: Returns the number of children.
+        '''
+        return self._profile.child_count[self._index]
+
+    def __iter__(self):
+        '''Iterate over the set of children in increasing order.
+
+        @rtype: iterator
+        @return: Returns an iterator which can be used to iterate over the
+        children.
+        '''
+        p = self._profile
+        i = p.first_child[self._index]
+        while i >= 0:
+            yield p.candidate[i]
+            i = p.next_sibling[i]
+
+    def iterchildren(self):
+        '''Iterate over the children in increasing order.
+
+        @rtype: iterator
+        @return: Returns an iterator that can be used to iterate over the
+        children and the corresponding nodes at the same time.
+        '''
+        p = self._profile
+        i = p.first_child[self._index]
+        while i >= 0:
+            yield (p.candidate[i], CompactNode(p, i))
+            i = p.next_sibling[i]
+
+class CompactProfile(CompactNode):
+    '''An array-backed profile which can be used in place of the root L{Node}
+    wherever the profile is only read.
+
+    The arrays are indexed by node; node 0 is the root.
+
+    @type candidate: C{array.array}
+    @ivar candidate: The candidate of each node. The root's is 0.
+    @type count: C{array.array}
+    @ivar count: The value of each node.
+    @type first_child: C{array.array}
+    @ivar first_child: The index of the first child of each node or -1.
+    @type next_sibling: C{array.array}
+    @ivar next_sibling: The index of the next child of the node's parent or -1.
+    @type child_count: C{array.array}
+    @ivar child_count: The number of children of each node.
+    '''
+    __slots__ = ('candidate', 'count', 'first_child', 'next_sibling',
+                 'child_count')
+
+    def __init__(self, root):
+        '''Create a compact copy of the tree rooted at C{root}.
+
+        @type  root: L{Node}
+        @param root: The root of the profile.
+        '''
+        CompactNode.__init__(self, self, 0)
+        candidate = [0]
+        count = [root.value]
+        first_child = []
+        next_sibling = [-1]
+        child_count = []
+        nodes = [root]
+        i = 0
+        while i < len(nodes):
+            children = sorted(nodes[i].iterchildren())
+            child_count.append(len(children))
+            if not children:
+                first_child.append(-1)
+            else:
+                first = len(nodes)
+                first_child.append(first)
+                for c, node in children:
+                    candidate.append(c)
+                    count.append(node.value)
+                    next_sibling.append(len(nodes)+1)
+                    nodes.append(node)
+                next_sibling[-1] = -1
+            i += 1
+        self.candidate = array.array('H', candidate)
+        self.count = array.array('i', count)
+        self.first_child = array.array('i', first_child)
+        self.next_sibling = array.array('i', next_sibling)
+        self.child_count = array.array('H', child_count)
+
+    def __repr__(self):
+        '''Return a representation of self.
+
+        @rtype: string
+        @return: Returns a string representation of the profile.
+        '''
+        return 'CompactProfile(value=%d, children=%s)' % \
+                (self.value, repr(dict(self.iterchildren())))
+
+    def __len__(self):
+        '''Return the number of nodes.
+
+        @rtype: number
+        @return: Returns the number of nodes in the profile.
+        '''
+        return len(self.count)
+
+    def nbytes(self):
+        '''Return the number of bytes used by the arrays.
+
+        @rtype: number
+        @return: Returns the size of the arrays in bytes.
+        '''
+        return sum(a.itemsize * len(a) for a in (self.candidate, self.count,
+                self.first_child, self.next_sibling, self.child_count))
+
+# vim: set sw=4 sts=4 tw=0 expandtab:
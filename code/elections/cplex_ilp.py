@@ -23,11 +23,10 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 '''
-This module implements the integer-linear programming methods for computing
-the IRV margin exactly using the CPLEX library.
+This module solves the integer-linear programs from L{ilp.Layout} and
+L{ilp.bounds} using the CPLEX library.
 '''
 import os
-import itertools
 
 import cplex
 from cplex._internal._constants import CPXMIP_OPTIMAL, CPXMIP_OPTIMAL_TOL
@@ -43,6 +42,7 @@ def _optimization_problem():
     os.close(stderr)
     prob.set_results_stream(None)
     prob.set_log_stream(None)
+    prob.set_warning_stream(None)
     prob.objective.set_sense(prob.objective.sense.minimize)
     # Set wall clock time
     # pylint can't tell that these RootParameterGroup types have the appropriate
@@ -53,160 +53,71 @@ def _optimization_problem():
     # pylint: enable=E1103
     return prob
 
-_prob = None
+def load(layout):
+    '''Build a program and load it into a new Cplex object.
 
-def _ballot_to_name(b):
-    '''Construct a string representation of ballots'''
-    return 'S' + ''.join('%02d' % c for c in b)
-    
-def _tree_to_map_helper(root, profile, b):
-    '''Helper for constructing the ballot profile.'''
-    num = 0
-    for c, n in root.iterchildren():
-        num += n.value
-        b.append(c)
-        _tree_to_map_helper(n, profile, b)
-        b.pop()
-    if root.value > num:
-        profile[_ballot_to_name(b)] = root.value-num
-
-def _tree_to_map(root):
-    '''Construct a ballot profile from a tree.'''
-    profile = {}
-    _tree_to_map_helper(root, profile, [])
-    return profile
-
-def _powerset(iterable, maxsize=None):
-    '''Return the powerset of iterable.'''
-    s = tuple(iterable)
-    if maxsize == None:
-        maxsize = len(s)
-    else:
-        maxsize = min(len(s), maxsize)
-    return itertools.chain.from_iterable(itertools.combinations(s, r) for r in range(maxsize+1))
-
-def _compute_special(profile, v, coef):
-    '''Compute the special inequalities'''
-    variables = []
-    coefs = []
-    rhs = 0
-    for signature in v:
-        variables.append('P' + signature)
-        coefs.append(coef)
-        if signature in profile:
-            variables.append('M' + signature)
-            coefs.append(-coef)
-            rhs += profile[signature]
-    return variables, coefs, rhs
-
-def distance_to(root, ranks, elim_order, timeout):
-    '''Compute the distance_to function from Magrino et al.
+    @type  layout: L{ilp.Layout}
+    @param layout: The program.
+    @rtype: dict
+    @return: Returns the state of the loaded program.
+    '''
+    prob = _optimization_problem()
+    num = len(layout.obj)
+    prob.variables.add(obj=layout.obj.tolist(), types='I'*num)
+    cols = layout.cols.tolist()
+    coefs = layout.coefs.tolist()
+    indptr = layout.indptr.tolist()
+    rows = [[cols[a:b], coefs[a:b]] for a, b in zip(indptr[:-1], indptr[1:])]
+    prob.linear_constraints.add(lin_expr=rows, senses=layout.senses,
+                                rhs=[0]*layout.num_rows)
+    return {'prob': prob, 'variables': range(num),
+            'constraints': range(layout.num_rows), 'start': None}
+
+def update(state, ub, rhs):
+    '''Set the variable upper bounds and the right-hand sides of a loaded
+    program.
+
+    @type  state: dict
+    @param state: The state returned by L{load}.
+    @type  ub: C{numpy.ndarray}
+    @param ub: The upper bounds of the variables.
+    @type  rhs: C{numpy.ndarray}
+    @param rhs: The right-hand sides of the constraints.
+    '''
+    prob = state['prob']
+    prob.variables.set_upper_bounds(zip(state['variables'], ub.tolist()))
+    prob.linear_constraints.set_rhs(zip(state['constraints'], rhs.tolist()))
 
-    This formulation differs from Magrino et al. in three ways.
-        1. The y_S variables are all removed so all that remains are p_S and m_S;
-        2. The constraints on the p_S and m_S are replaced with simple bounds; and
-        3. The objective function changed for the new definition of margin.
-    
-    3 is the most important. The original objective function was sum_S p_S.
-    We want sum_{S != ()} (p_S + m_S). This works, but seems to be horribly
-    inefficient. Using sum_S p_S = sum_S m_S, we can rewrite this as
-    2*sum_{S != ()} m_S - p_{()} + m_{()}.
+def solve(state, timeout, warm_start=False):
+    '''Solve a loaded program.
 
-    @type  root: L{Node}
-    @param root: Root of the ballot tree.
-    @type  ranks: number
-    @param ranks: The maximum number of candidates a voter can rank.
-    @type  elim_order: list
-    @param elim_order: The elimination order we would like.
+    @type  state: dict
+    @param state: The state returned by L{load}.
     @type  timeout: number
     @param timeout: The computation timeout.
+    @type  warm_start: boolean
+    @param warm_start: If C{True}, give CPLEX the previous solution of the
+    program, if there was one, as a start to repair into a solution of this
+    one.
     @rtype: number
-    @return: Returns -1 on timeout. Otherwise, it returns the margin.
+    @return: Returns -1 on timeout. Otherwise, it returns the optimal
+    objective value.
     '''
-
-    k = len(elim_order)
-    if k < 2:
-        return 0
-    global _prob
-    if _prob is None:
-        _prob = _optimization_problem()
-    root = root.deepcopy()
-    root.reduce(elim_order)
-    n = root.value
-    profile = _tree_to_map(root)
-
-    # add variables and constraints
-    obj = []
-    ub = []
-    names = []
-    basic = [[], []]
-    constraints = [basic]
-    # Ugh, this looks awful.
-    # special[i][j] is the list of ballots that count for candidate elim_order[i+j]
-    # in round i in {0,1,...,k-2}
-    special = [[[] for _ in range(i, k)] for i in range(k-1)]
-    rhs = [0]
-    for subset in _powerset(range(len(elim_order)), ranks):
-        # We don't need both final round candidates on a ballot
-        if k-1 in subset and k-2 in subset:
-            continue
-
-        signature = _ballot_to_name(elim_order[i] for i in subset)
-        # Add P_S and M_S
-        ps = 'P' + signature
-        if signature in profile:
-            ms = 'M' + signature
-            ns = profile[signature]
-            names.extend((ps, ms))
-            if subset:
-                obj.extend((0, 2))
-            else:
-                obj.extend((-1, 1))
-            ub.extend((n-ns, ns))
-            basic[0].extend((ps, ms))
-            basic[1].extend((1, -1))
-        else:
-            names.append(ps)
-            if subset:
-                obj.append(0)
-            else:
-                obj.append(-1)
-            ub.append(n)
-            basic[0].append(ps)
-            basic[1].append(1)
-        # Construct the special inequality sets P_{i,j}
-        r = 0
-        for i in subset:
-            for s in special[r:i+1]:
-                s[i-r].append(signature)
-                r += 1
-
-    # Now add in the special inequalities
-    for s in special:
-        iset, icoef, irhs = _compute_special(profile, s[0], 1)
-        for t in s[1:]:
-            jset, jcoef, jrhs = _compute_special(profile, t, -1)
-            constraints.append([iset + jset, icoef + jcoef])
-            rhs.append(jrhs - irhs)
-    numspecial = (k*(k-1)) >> 1 # sum_{i=1}^{k-1} i = k(k-1)/2
-    senses = 'E' + 'L'*numspecial
-
-
-    # Construct problem and solve
-    _prob.variables.delete()
-    _prob.linear_constraints.delete()
-    _prob.variables.add(obj=obj, ub=ub, types='I'*len(obj), names=names)
-    _prob.linear_constraints.add(lin_expr=constraints, senses=senses, rhs=rhs)
+    prob = state['prob']
     # pylint: disable=E1103
-    _prob.parameters.timelimit.set(timeout)
+    if warm_start and state['start'] is not None:
+        prob.MIP_starts.delete()
+        prob.MIP_starts.add([state['variables'], state['start']],
+                            prob.MIP_starts.effort_level.repair)
+    prob.parameters.timelimit.set(timeout)
     # pylint: enable=E1103
-    _prob.solve()
-    #print _prob.solution.status[_prob.solution.get_status()]
-    status = _prob.solution.get_status()
+    prob.solve()
+    #print prob.solution.status[prob.solution.get_status()]
+    status = prob.solution.get_status()
     if status not in (CPXMIP_OPTIMAL, CPXMIP_OPTIMAL_TOL):
         return -1
-    m = _prob.solution.get_objective_value()
-    #print m, zip(_prob.variables.get_names(), _prob.solution.get_values())
-    return m
+    if warm_start:
+        state['start'] = prob.solution.get_values()
+    return prob.solution.get_objective_value()
 
 # vim: set sw=4 sts=4 tw=0 expandtab:
@@ -0,0 +1,150 @@
+# Copyright (c) 2011, Stephen Checkoway <s@cs.ucsd.edu>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+Implement IRV over a dense matrix of ballots.
+
+A profile is stored as an C{int8} matrix with one row per ballot and one
+column per rank, padded with zeros, together with a vector of ballot
+weights. Each round finds the current top choice of every ballot and the
+first-preference totals with whole-array operations rather than a walk over
+a tree of L{Node}s.
+'''
+
+import numpy
+
+import irv
+
+def build_dense(election):
+    '''Build and return the dense ballot matrix and weights of an Election.
+
+    Each distinct ballot of the profile is one row of the matrix. This assumes
+    the children of root are the integers 1, 2, ..., k.
+
+    @type  election: L{Election}
+    @param election: The election.
+    @rtype: C{numpy.ndarray}, C{numpy.ndarray}
+    @return: Returns the ballots x ranks C{int8} matrix and the C{int64}
+    vector of weights.
+    '''
+    root = election.profile
+    if root.num_children() > 127:
+        raise Exception('Cannot store more than 127 candidates in an int8 matrix.')
+    ballots = []
+    weights = []
+    # The number of ballots ending at a node is its value minus the values of
+    # its children
+    stack = [(child, (c,)) for c, child in root.iterchildren()]
+    while stack:
+        node, ballot = stack.pop()
+        num = node.value
+        for c, child in node.iterchildren():
+            num -= child.value
+            stack.append((child, ballot + (c,)))
+        if num > 0:
+            ballots.append(ballot)
+            weights.append(num)
+    ranks = max(len(b) for b in ballots) if ballots else 0
+    m = numpy.zeros((len(ballots), ranks), numpy.int8)
+    for i, ballot in enumerate(ballots):
+        m[i, :len(ballot)] = ballot
+    return m, numpy.array(weights, numpy.int64)
+
+def dense_irv(ballots, weights, num_candidates, rules=irv.BASE_IRV_RULES):
+    '''Perform IRV using C{rules} and return the winner, vote counts, and
+    elimination order.
+
+    This gives the same result as L{irv.irv}, except that the vote counts of
+    each candidate are a C{numpy} array.
+
+    @type  ballots: C{numpy.ndarray}
+    @param ballots: The ballots x ranks matrix of candidates, padded with 0.
+    @type  weights: C{numpy.ndarray}
+    @param weights: The number of voters casting each ballot.
+    @type  num_candidates: number
+    @param num_candidates: The number of candidates, numbered 1, 2, ..., k.
+    @type  rules: enum
+    @param rules: The rules to use.
+    @rtype: number, dict, list
+    @return: Returns the winner, the vote counts, and the elimination order.
+    '''
+    k = num_candidates
+    n, ranks = ballots.shape
+    # A column of zeros past the last rank marks exhausted ballots
+    padded = numpy.zeros((n, ranks+1), numpy.int8)
+    padded[:, :ranks] = ballots
+    weights = numpy.asarray(weights, numpy.float64)
+    continuing = numpy.ones(k+1, numpy.bool_)
+    continuing[0] = False
+    position = numpy.zeros(n, numpy.intp)
+    top = padded[:, 0].copy()
+    rows = numpy.arange(n)
+    # Return values
+    winner = None
+    counts = numpy.zeros((k+1, k), numpy.int64)
+    elimination = []
+
+    r = 0
+    while r < k:
+        r += 1
+        # Move each ballot whose top choice has been eliminated to its next
+        # continuing choice
+        stale = rows[(top != 0) & ~continuing[top]]
+        while len(stale):
+            position[stale] += 1
+            top[stale] = padded[stale, position[stale]]
+            stale = stale[(top[stale] != 0) & ~continuing[top[stale]]]
+
+        tally = numpy.bincount(top, weights=weights, minlength=k+1)
+        tally = numpy.rint(tally).astype(numpy.int64)
+        counts[:, r-1] = tally
+        candidates = numpy.flatnonzero(continuing)
+        votes = [(int(c), int(tally[c])) for c in candidates]
+        num_votes = sum(v for _, v in votes)
+        high_candidate = 0
+        high_votes = 0
+        for c, v in votes:
+            if v > high_votes:
+                high_candidate = c
+                high_votes = v
+
+        # Check if the candidate with the most votes has a majority
+        if rules != irv.COMPLETE_IRV_RULES and high_votes*2 > num_votes \
+                or len(votes) <= 2:
+            winner = high_candidate
+            final_elim = set(c for c, _ in votes)
+            final_elim.remove(winner)
+            elimination.append(final_elim)
+            break
+
+        # pylint: disable=W0212
+        lowest = irv._votes_elimination_set(votes, rules)
+        # pylint: enable=W0212
+        continuing[list(lowest)] = False
+        elimination.append(lowest)
+
+    counts = dict((c, counts[c, :r]) for c in xrange(1, k+1))
+    return (winner, counts, elimination)
+
+# vim: set sw=4 sts=4 tw=0 expandtab:
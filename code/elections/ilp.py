@@ -0,0 +1,472 @@
+# Copyright (c) 2011, Stephen Checkoway <s@cs.ucsd.edu>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+This module contains the integer-linear program for computing the IRV margin
+exactly and selects the optimization library that solves it.
+
+The program for an elimination order of C{k} candidates is written in terms
+of the positions of the candidates in the order rather than the candidates
+themselves. Its variables, objective and constraint matrix, the L{Layout},
+then depend only on C{k} and the number of ranks. Only the variable bounds
+and the right-hand sides depend on the order and the ballots. A L{Session}
+keeps the program loaded in the solver and, from one elimination order to
+the next, changes only those.
+
+Each library is wrapped by a module with three functions:
+C{load(layout)} returns the library's state for a loaded program,
+C{update(state, ub, rhs)} sets its bounds and right-hand sides, and
+C{solve(state, timeout, warm_start)} returns the optimal objective value or
+-1 if the program could not be solved in time. L{cplex_ilp} uses CPLEX and
+L{cbc_ilp} uses the open-source CBC solver through PuLP. Libraries that
+cannot be imported are skipped.
+'''
+
+import itertools
+import time
+
+import numpy
+
+CPLEX, CBC = 'cplex', 'cbc'
+
+# The solvers in order of preference
+SOLVERS = (CPLEX, CBC)
+
+# The solver modules that have been imported, or None if they could not be
+_modules = {}
+
+# The session used by distance_to() for each solver
+_sessions = {}
+
+def solver_module(solver=None):
+    '''Return the module wrapping an optimization library.
+
+    @type  solver: string
+    @param solver: L{CPLEX}, L{CBC}, or C{None} for the first one in
+    L{SOLVERS} that can be loaded.
+    @rtype: module
+    @return: Returns the module.
+    @raise Exception: If the library cannot be loaded.
+    '''
+    if solver is None:
+        for solver in SOLVERS:
+            module = _load(solver)
+            if module is not None:
+                return module
+        raise Exception('No optimizer library could be loaded.')
+    if solver not in SOLVERS:
+        raise Exception('Unknown optimizer library %s.' % solver)
+    module = _load(solver)
+    if module is None:
+        raise Exception('The optimizer library %s could not be loaded.' % solver)
+    return module
+
+def _load(solver):
+    '''Import and return the module for solver or C{None}.'''
+    if solver not in _modules:
+        try:
+            if solver == CPLEX:
+                import cplex_ilp as module
+            else:
+                import cbc_ilp as module
+        except ImportError:
+            module = None
+        _modules[solver] = module
+    return _modules[solver]
+
+def available():
+    '''Return the solvers whose libraries can be loaded.
+
+    @rtype: list
+    @return: Returns the solvers in order of preference.
+    '''
+    return [solver for solver in SOLVERS if _load(solver) is not None]
+
+def session(solver=None):
+    '''Return the L{Session} that L{distance_to} uses for a solver.
+
+    @type  solver: string
+    @param solver: The optimization library, see L{solver_module}.
+    @rtype: L{Session}
+    @return: Returns the session.
+    '''
+    if solver not in _sessions:
+        _sessions[solver] = Session(solver)
+    return _sessions[solver]
+
+def reset():
+    '''Forget the sessions of every solver.
+
+    A forked process must not share a solver created by its parent, so this
+    must be called in the child before solving anything.
+    '''
+    _sessions.clear()
+
+def _ramp(counts):
+    '''Return the concatenation of C{arange(c)} for each C{c} in counts.'''
+    total = counts.sum()
+    return numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+
+# This class has no methods at all, it's just a struct, so disable the warning
+# about not having enough public messages.
+# pylint: disable=R0903
+class Layout(object):
+    '''This class holds the part of the program for the distance_to function
+    from Magrino et al. that depends only on the number of candidates and
+    ranks.
+
+    This formulation differs from Magrino et al. in three ways.
+        1. The y_S variables are all removed so all that remains are p_S and m_S;
+        2. The constraints on the p_S and m_S are replaced with simple bounds; and
+        3. The objective function changed for the new definition of margin.
+    
+    3 is the most important. The original objective function was sum_S p_S.
+    We want sum_{S != ()} (p_S + m_S). This works, but seems to be horribly
+    inefficient. Using sum_S p_S = sum_S m_S, we can rewrite this as
+    2*sum_{S != ()} m_S - p_{()} + m_{()}.
+
+    A signature C{S} is a set of positions in the elimination order, listed
+    in increasing order on the ballots that have it. Signature 0 is the
+    empty ballot. Every signature has an m_S, with index C{num_p + q} for
+    signature C{q}; the m_S of a signature that no ballot has is bounded by
+    0, so the solver's presolve removes it. The p_S, with indices C{0} up to
+    C{num_p}, are those of the signatures in C{p_signatures}.
+
+    In the sparse formulation, p_S is only created for signatures that are
+    not dominated. Adding a ballot with signature S changes the constraints
+    of a round only through the candidate S counts for, and counting for
+    the candidate eliminated in the round is the worst. So p_S is dominated
+    by p_T, meaning moving added ballots from S to T keeps every solution
+    feasible without raising the objective, when T is S with
+        1. position 0 removed;
+        2. position C{i+1} removed, if S has C{i} and C{i+1}; or
+        3. position C{k-1} added, if S is nonempty, has no position after
+           C{k-3}, and ranks fewer than C{ranks}, since candidate C{k-1} is
+           never eliminated.
+    An optimal solution that has both p_S and m_S positive for some S can
+    lower both, so there is one with p_S <= n - n_S for every S that can be
+    moved onto undominated signatures. The sparse program therefore has
+    the same optimal objective value.
+
+    The program minimizes C{obj} over nonnegative integer variables. The
+    constraint matrix is given by its nonzero entries C{coefs[e]} in row
+    C{rows[e]} and column C{cols[e]}, sorted by row, so the entries of row
+    C{i} are those from C{indptr[i]} up to C{indptr[i+1]}. Row 0 is the equation
+    sum_S p_S = sum_S m_S and the other rows are the C{<=} constraints that
+    the candidate eliminated in a round has no more votes than a candidate
+    eliminated later. The right-hand side of a row is the sum of
+    C{special_coefs[e]} times the number of ballots with signature
+    C{special_signatures[e]} over the entries with C{special_rows[e]} equal
+    to the row.
+
+    @type size: number
+    @ivar size: The number of signatures.
+    @type p_signatures: C{numpy.ndarray}
+    @ivar p_signatures: The signatures that have a p_S.
+    @type num_p: number
+    @ivar num_p: The number of p_S.
+    @type index: dict
+    @ivar index: Mapping from the bitmask of the positions in each
+    signature to the signature.
+    @type num_rows: number
+    @ivar num_rows: The number of constraints.
+    @type obj: C{numpy.ndarray}
+    @ivar obj: The objective coefficients of the variables.
+    @type rows: C{numpy.ndarray}
+    @ivar rows: The rows of the nonzero constraint coefficients.
+    @type cols: C{numpy.ndarray}
+    @ivar cols: The columns of the nonzero constraint coefficients.
+    @type coefs: C{numpy.ndarray}
+    @ivar coefs: The nonzero constraint coefficients.
+    @type indptr: C{numpy.ndarray}
+    @ivar indptr: The start of the entries of each row.
+    @type senses: string
+    @ivar senses: The senses of the constraints, C{'E'} for C{=} and C{'L'}
+    for C{<=}.
+    @type special_rows: C{numpy.ndarray}
+    @ivar special_rows: The rows of the right-hand side coefficients.
+    @type special_signatures: C{numpy.ndarray}
+    @ivar special_signatures: The signatures of the right-hand side
+    coefficients.
+    @type special_coefs: C{numpy.ndarray}
+    @ivar special_coefs: The right-hand side coefficients.
+    '''
+    def __init__(self, k, ranks, sparse=True):
+        '''Create the layout for elimination orders of k candidates.
+
+        @type  k: number
+        @param k: The number of candidates.
+        @type  ranks: number
+        @param ranks: The maximum number of candidates a voter can rank.
+        @type  sparse: boolean
+        @param sparse: If C{True}, only create the p_S that are not
+        dominated.
+        '''
+        object.__init__(self)
+        # The signatures of each size as rows of positions
+        groups = []
+        undominated = []
+        for m in range(min(k, ranks) + 1):
+            combinations = list(itertools.combinations(range(k), m))
+            group = numpy.array(combinations, dtype=numpy.int64)
+            group = group.reshape(len(combinations), m)
+            if m >= 2:
+                # We don't need both final round candidates on a ballot
+                group = group[~((group == k-1).any(1) & (group == k-2).any(1))]
+            groups.append(group)
+            keep = numpy.ones(len(group), dtype=bool)
+            if sparse and m:
+                keep &= group[:, 0] != 0
+                keep &= (numpy.diff(group, axis=1) != 1).all(1)
+                if m < ranks:
+                    keep &= group[:, -1] >= k-2
+            undominated.append(keep)
+        masks = numpy.concatenate([(1 << group).sum(1) for group in groups])
+        self.size = len(masks)
+        self.index = dict(itertools.izip(masks.tolist(), itertools.count()))
+        self.p_signatures = numpy.flatnonzero(numpy.concatenate(undominated))
+        self.num_p = len(self.p_signatures)
+        # The index of the p_S of each signature or -1
+        p_index = -numpy.ones(self.size, dtype=numpy.int64)
+        p_index[self.p_signatures] = numpy.arange(self.num_p)
+        self.obj = numpy.concatenate((numpy.zeros(self.num_p),
+                                      2*numpy.ones(self.size)))
+        self.obj[0] = -1
+        self.obj[self.num_p] = 1
+
+        # The ballots with signature q count for the candidate in position i
+        # in round r: i is the first position of q that is at least r.
+        qs = []
+        ps = []
+        rs = []
+        offset = 0
+        for m, group in enumerate(groups):
+            q = offset + numpy.arange(len(group))
+            for t in range(m):
+                pos = group[:, t]
+                if t:
+                    first = group[:, t-1] + 1
+                else:
+                    first = numpy.zeros_like(pos)
+                num = numpy.maximum(numpy.minimum(pos, k-2) - first + 1, 0)
+                qs.append(numpy.repeat(q, num))
+                ps.append(numpy.repeat(pos, num))
+                rs.append(numpy.repeat(first, num) + _ramp(num))
+            offset += len(group)
+        q = numpy.concatenate(qs)
+        r = numpy.concatenate(rs)
+        j = numpy.concatenate(ps) - r
+
+        # Round r has a row for each candidate in position r+j, j >= 1,
+        # saying the candidate in position r has no more votes.
+        row_of_round = numpy.concatenate(([0], numpy.cumsum(k-1 - numpy.arange(k-1))))
+        self.num_rows = 1 + (k*(k-1) >> 1) # sum_{i=1}^{k-1} i = k(k-1)/2
+        later = j > 0
+        now = ~later
+        reps = k-1 - r[now]
+        self.special_rows = numpy.concatenate((
+            row_of_round[r[later]] + j[later],
+            numpy.repeat(row_of_round[r[now]], reps) + 1 + _ramp(reps)))
+        self.special_signatures = numpy.concatenate((
+            q[later], numpy.repeat(q[now], reps)))
+        self.special_coefs = numpy.concatenate((
+            numpy.ones(later.sum()), -numpy.ones(reps.sum())))
+
+        # p_S counts toward the votes with the opposite sign of its
+        # right-hand side coefficient and m_S with the same sign
+        p_cols = p_index[self.special_signatures]
+        has_p = p_cols >= 0
+        rows = numpy.concatenate((
+            numpy.zeros(self.num_p + self.size, dtype=numpy.int64),
+            self.special_rows[has_p], self.special_rows))
+        cols = numpy.concatenate((
+            numpy.arange(self.num_p + self.size),
+            p_cols[has_p], self.num_p + self.special_signatures))
+        coefs = numpy.concatenate((
+            numpy.ones(self.num_p), -numpy.ones(self.size),
+            -self.special_coefs[has_p], self.special_coefs))
+        order = numpy.argsort(rows)
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.coefs = coefs[order]
+        self.indptr = numpy.searchsorted(self.rows, numpy.arange(self.num_rows+1))
+        self.senses = 'E' + 'L'*(self.num_rows-1)
+
+# The layouts that have been built, keyed by the number of candidates, ranks
+# and sparseness
+_layouts = {}
+
+def layout(k, ranks, sparse=True):
+    '''Return the L{Layout} for elimination orders of k candidates.
+
+    @type  k: number
+    @param k: The number of candidates.
+    @type  ranks: number
+    @param ranks: The maximum number of candidates a voter can rank.
+    @type  sparse: boolean
+    @param sparse: If C{True}, use the sparse formulation.
+    @rtype: L{Layout}
+    @return: Returns the layout.
+    '''
+    key = (k, ranks, sparse)
+    if key not in _layouts:
+        _layouts[key] = Layout(k, ranks, sparse)
+    return _layouts[key]
+
+def bounds(root, elim_order, lay):
+    '''Return the variable upper bounds and the right-hand sides of the
+    program for an elimination order.
+
+    @type  root: L{Node}
+    @param root: Root of the ballot tree.
+    @type  elim_order: list
+    @param elim_order: The elimination order we would like.
+    @type  lay: L{Layout}
+    @param lay: The layout for C{len(elim_order)} candidates.
+    @rtype: C{numpy.ndarray}, C{numpy.ndarray}
+    @return: Returns the upper bounds of the variables and the right-hand
+    sides of the constraints.
+    '''
+    root = root.fork()
+    root.reduce(elim_order)
+    n = root.value
+    bit = dict((c, 1 << i) for i, c in enumerate(elim_order))
+    # The number of ballots with each signature
+    counts = [0] * lay.size
+    index = lay.index
+    stack = [(root, 0)]
+    while stack:
+        node, mask = stack.pop()
+        num = 0
+        for c, child in node.iterchildren():
+            num += child.value
+            stack.append((child, mask | bit[c]))
+        if node.value > num:
+            counts[index[mask]] += node.value - num
+    counts = numpy.array(counts, dtype=float)
+    ub = numpy.concatenate((n - counts[lay.p_signatures], counts))
+    rhs = numpy.bincount(lay.special_rows,
+                         lay.special_coefs * counts[lay.special_signatures],
+                         minlength=lay.num_rows)
+    return ub, rhs
+
+class Session(object):
+    '''This class solves the programs of a sequence of elimination orders
+    with one solver, keeping the program loaded between them.
+
+    A program is built and loaded once for each number of candidates and
+    ranks. After that, only its bounds and right-hand sides are changed.
+
+    With C{warm_start}, the solver is given the previous solution of the
+    program as a start to repair. Consecutive elimination orders from
+    L{irv.irv_margin} rarely share a feasible solution, so the start is
+    almost never usable, and it made the 2010 Oakland City Council District
+    4 margin about 5% slower with CPLEX. It is off by default.
+
+    @type build_time: number
+    @ivar build_time: The seconds spent building, loading and updating
+    programs.
+    @type solve_time: number
+    @ivar solve_time: The seconds spent in the solver.
+    @type loads: number
+    @ivar loads: The number of programs built and loaded.
+    @type solves: number
+    @ivar solves: The number of programs solved.
+    '''
+    def __init__(self, solver=None, warm_start=False, sparse=True):
+        '''Create a new session.
+
+        @type  solver: string
+        @param solver: The optimization library, see L{solver_module}.
+        @type  warm_start: boolean
+        @param warm_start: If C{True}, start each solve from the previous
+        solution of the same program.
+        @type  sparse: boolean
+        @param sparse: If C{True}, use the sparse formulation of L{Layout}.
+        @raise Exception: If the library cannot be loaded.
+        '''
+        object.__init__(self)
+        self._module = solver_module(solver)
+        self._warm_start = warm_start
+        self._sparse = sparse
+        # The state of the loaded program of each layout
+        self._states = {}
+        self.build_time = 0.0
+        self.solve_time = 0.0
+        self.loads = 0
+        self.solves = 0
+
+    def distance_to(self, root, ranks, elim_order, timeout):
+        '''Compute the distance_to function from Magrino et al.
+
+        @type  root: L{Node}
+        @param root: Root of the ballot tree.
+        @type  ranks: number
+        @param ranks: The maximum number of candidates a voter can rank.
+        @type  elim_order: list
+        @param elim_order: The elimination order we would like.
+        @type  timeout: number
+        @param timeout: The computation timeout.
+        @rtype: number
+        @return: Returns -1 on timeout. Otherwise, it returns the margin.
+        '''
+        k = len(elim_order)
+        if k < 2:
+            return 0
+        then = time.time()
+        lay = layout(k, ranks, self._sparse)
+        state = self._states.get(lay)
+        if state is None:
+            state = self._module.load(lay)
+            self._states[lay] = state
+            self.loads += 1
+        ub, rhs = bounds(root, elim_order, lay)
+        self._module.update(state, ub, rhs)
+        now = time.time()
+        self.build_time += now - then
+        m = self._module.solve(state, timeout, self._warm_start)
+        self.solve_time += time.time() - now
+        self.solves += 1
+        return m
+
+def distance_to(root, ranks, elim_order, timeout, solver=None):
+    '''Compute the distance_to function from Magrino et al. using the
+    L{session} of a solver.
+
+    @type  root: L{Node}
+    @param root: Root of the ballot tree.
+    @type  ranks: number
+    @param ranks: The maximum number of candidates a voter can rank.
+    @type  elim_order: list
+    @param elim_order: The elimination order we would like.
+    @type  timeout: number
+    @param timeout: The computation timeout.
+    @type  solver: string
+    @param solver: The optimization library, see L{solver_module}.
+    @rtype: number
+    @return: Returns -1 on timeout. Otherwise, it returns the margin.
+    '''
+    return session(solver).distance_to(root, ranks, elim_order, timeout)
+
+# vim: set sw=4 sts=4 tw=0 expandtab:
@@ -31,11 +31,15 @@ Implement all the functions for computing IRV margins and bounds.
 import heapq
 import itertools
 import math
+import multiprocessing
 import sys
 import time
 
+import cache
+from tally import Tally, flatten
+
 try:
-    import cplex_ilp as ilp
+    import ilp
 except ImportError:
     ilp = None
 
@@ -62,14 +66,33 @@ def _elimination_set(root, rules, all_sets=None):
     Note that ties are handled by selecting one of the candidates with the
     fewest top-choice votes.
     '''
+    votes = [(c, n.value) for c, n in root.iterchildren()]
+    return _votes_elimination_set(votes, rules, all_sets)
+
+def _votes_elimination_set(votes, rules, all_sets=None):
+    '''Return the IRV elimination set for the top-choice votes.
+
+    See L{_elimination_set}. Ties are broken in favor of the candidate that
+    comes first in C{votes}.
+
+    @type  votes: list
+    @param votes: The (candidate, top-choice votes) pairs.
+    @type  rules: enum
+    @param rules: The rules to use to determine the set.
+    @type  all_sets: list
+    @param all_sets: If C{rules =} L{SF_RCV_RULES}, and all_sets is a list, append
+    every valid elimination set.
+    @rtype: set
+    @return: Returns the set of candidates to eliminate.
+    '''
     if rules == BASE_IRV_RULES or rules == COMPLETE_IRV_RULES:
         # Remove the candidate with the fewest votes
         low_candidate = 0
         low_votes = sys.maxint
-        for c, n in root.iterchildren():
-            if n.value < low_votes:
+        for c, v in votes:
+            if v < low_votes:
                 low_candidate = c
-                low_votes = n.value
+                low_votes = v
         return set([low_candidate])
     elif rules == SF_RCV_RULES:
         # S.F., Cal., Charter art. XIII s. 13.102(e)
@@ -88,8 +111,9 @@ def _elimination_set(root, rules, all_sets=None):
 
         # Sort the candidates based on votes received and then group them
         # by vote totals
-        sorted_candidates = sorted(root.__iter__(), key=lambda c: root.get_child(c).value)
-        groups = itertools.groupby(sorted_candidates, key=lambda c: root.get_child(c).value)
+        value = dict(votes)
+        sorted_candidates = sorted((c for c, _ in votes), key=value.get)
+        groups = itertools.groupby(sorted_candidates, key=value.get)
         groups = ((k, len(tuple(g))) for k, g in groups)
         n = 0 # sum of votes for sortedCandidates[:j]
         i = 0 # sortedCandidates[:i] are definitely going to be eliminated
@@ -124,7 +148,7 @@ def irv_round(profile, rounds, rules=BASE_IRV_RULES):
     list of elimination sets used, and the reduced tree after having eliminated
     candidates.
     '''
-    root = profile.deepcopy()
+    root = profile.fork()
     candidates = root.children()
     eliminated = set()
     # Return values
@@ -163,9 +187,8 @@ def irv_round(profile, rounds, rules=BASE_IRV_RULES):
         lowest = _elimination_set( root, rules )
 
         # Eliminate these candidates
-        for c in lowest:
-            root.eliminate(c)
-            eliminated.add(c)
+        root.eliminate_set(lowest)
+        eliminated.update(lowest)
         # Add them to the elimination order
         elimination.append(lowest)
     
@@ -177,6 +200,10 @@ def irv_round(profile, rounds, rules=BASE_IRV_RULES):
 def irv(election, rules=BASE_IRV_RULES):
     '''Perform IRV using C{rules} and return the winner, vote counts, and
     elimination order.
+
+    This gives the same result as L{irv_round} but counts the votes with a
+    L{Tally}, so each round only moves the ballots of the eliminated
+    candidates.
     
     @type  election: L{Election}
     @param election: The election.
@@ -185,8 +212,47 @@ def irv(election, rules=BASE_IRV_RULES):
     @rtype: number, dict, list
     @return: Returns the winner, the vote counts, and the elimination order.
     '''
-    root = election.profile
-    winner, counts, elimination, _ = irv_round(root, root.num_children(), rules=rules)
+    tally = Tally(election.profile)
+    candidates = tally.candidates()
+    rounds = len(candidates)
+    # Return values
+    winner = None
+    counts = dict((c, rounds*[0]) for c in candidates)
+    elimination = []
+
+    r = 0
+    while r < rounds:
+        r += 1
+        num_votes = 0
+        high_candidate = 0
+        high_votes = 0
+
+        # Record the number of votes each candidate gets in this round
+        votes = list(tally.iteritems())
+        for c, v in votes:
+            counts[c][r-1] = v
+            num_votes += v
+            if v > high_votes:
+                high_candidate = c
+                high_votes = v
+
+        # Check if the candidate with the most votes has a majority
+        if rules != COMPLETE_IRV_RULES and high_votes*2 > num_votes \
+                or len(tally) <= 2:
+            winner = high_candidate
+            final_elim = tally.candidates()
+            final_elim.remove(winner)
+            elimination.append(final_elim)
+            break
+
+        # Eliminate the candidates and add them to the elimination order
+        lowest = _votes_elimination_set(votes, rules)
+        tally.eliminate_set(lowest)
+        elimination.append(lowest)
+
+    if r < rounds:
+        for c in counts.keys():
+            del counts[c][r-rounds:]
     return (winner, counts, elimination)
 
 
@@ -201,18 +267,23 @@ def irv_simple_lb(election, rules=SF_RCV_RULES):
     @rtype: number
     @return: Returns the lower bound.
     '''
-    root = election.profile
+    tally = Tally(election.profile)
     lb = sys.maxint
-    winner = None
-    while winner is None:
-        elim_set = _elimination_set(root, rules=rules)
-        continuing = root.children() - elim_set
-        m = min(root.get_child(c).value for c in continuing) - sum(root.get_child(c).value for c in elim_set)
+    while True:
+        votes = list(tally.iteritems())
+        num_votes = sum(v for _, v in votes)
+        high_votes = max(v for _, v in votes)
+        elim_set = _votes_elimination_set(votes, rules)
+        continuing = tally.candidates() - elim_set
+        m = min(tally.value(c) for c in continuing) - sum(tally.value(c) for c in elim_set)
         lb = min(lb, m)
-        winner, _, _, root = irv_round(root, 1, rules=rules)   
-    return lb
+        if rules != COMPLETE_IRV_RULES and high_votes*2 > num_votes \
+                or len(tally) <= 2:
+            return lb
+        tally.eliminate_set(elim_set)
 
-def irv_margin(election, winner=None, elim_order=None, ub=None, trace=False, timeout=1e75):
+def irv_margin(election, winner=None, elim_order=None, ub=None, trace=False, timeout=1e75,
+               jobs=1, cache_dir=None, stats=None, solver=None):
     '''Compute the exact IRV margin of the election.
 
     @type  election: L{Election}
@@ -227,11 +298,36 @@ def irv_margin(election, winner=None, elim_order=None, ub=None, trace=False, tim
     @param trace: If C{True}, print a trace of the computation.
     @type  timeout: number
     @param timeout: The amount of time to spend computing the margin.
+    @type  jobs: number
+    @param jobs: The number of worker processes solving the integer-linear
+    programs. Each worker has its own solver. If C{None}, use one per CPU.
+    The programs of the best bounded fringe entries are solved together, but
+    each distance is only used when its entry reaches the top of the fringe,
+    so the fringe, the result and the counts in C{stats} are the same for
+    any number of workers.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory in which the distances are
+    memoized. If C{None}, use L{cache.CACHE_DIR}.
+    @type  stats: dict
+    @param stats: If not C{None}, C{'hits'} and C{'misses'} are set to
+    the number of distances found and not found in the cache, C{'saved'} to
+    the solver time in seconds the hits originally took, C{'solved'} to
+    the solver time spent on the misses, C{'build'} to the part of it spent
+    building and updating the programs, C{'prefixes'} to the number of
+    elimination orders considered and C{'pruned'} to the number of them
+    whose lower bound exceeded C{ub}.
+    @type  solver: string
+    @param solver: The optimization library that solves the integer-linear
+    programs, L{ilp.CPLEX} or L{ilp.CBC}. If C{None}, use the first one
+    that can be loaded.
     @rtype: number
     @return: Returns the IRV margin.
+    @raise Exception: If the optimization library cannot be loaded.
     '''
     if ilp is None:
-        raise Exception('Cannot compute irv_margin() because no optimizer library could be loaded.')
+        raise Exception('Cannot compute irv_margin() because numpy could not be loaded.')
+    # Fail now rather than in the first worker
+    ilp.solver_module(solver)
     then = time.time()
     if winner is None or elim_order is None:
         winner, _, elim_order = irv(election)
@@ -241,7 +337,7 @@ def irv_margin(election, winner=None, elim_order=None, ub=None, trace=False, tim
     # We can eliminate candidates who _must_ be eliminated first.  The
     # reasoning is that for them to not be eliminated, more votes would have to
     # be shifted than the upper bound on the margin.
-    root = election.profile.deepcopy()
+    root = election.profile.fork()
     while True:
         esets = []
         _elimination_set(root, all_sets=esets, rules=SF_RCV_RULES)
@@ -256,10 +352,10 @@ def irv_margin(election, winner=None, elim_order=None, ub=None, trace=False, tim
                 max_eset = eset
         if not max_eset:
             break
-        for c in max_eset:
-            if trace:
+        if trace:
+            for c in max_eset:
                 print 'Eliminating candidate %d' % c
-            root.eliminate(c)
+        root.eliminate_set(max_eset)
 
     # This is the algorithm from Magrino et al., more or less
     candidates = root.children()
@@ -276,97 +372,324 @@ def irv_margin(election, winner=None, elim_order=None, ub=None, trace=False, tim
         print tertiary
         
     ranks = election.ranks
+    ballots = flatten(root)
+    # Each fringe entry is a lower bound on the distance to any elimination
+    # order ending in elim, the secondary and tertiary keys, whether the
+    # bound is only the cheap one from _prefix_lbs(), and elim. The distance
+    # to an order is at least the distance to any suffix of it, so the first
+    # exact distance to a complete order popped from the fringe is the
+    # margin. The distance to a prefix is only used when its entry reaches
+    # the top of the fringe.
     fringe = []
     for c in candidates:
         if c == winner:
             continue
         if trace:
             print '\t', '(%d)' % c, 0, -1, 0
-        heapq.heappush(fringe, (0, -1, 0, [c]))
-    while True:
-        d, s, t, elim = heapq.heappop(fringe)
-        if trace:
-            print tuple(elim), d, s, t
-        if len(elim) == k:
-            return d
-        now = time.time()
-        timeout -= now - then
-        if timeout <= 0.0:
-            return -1
-        then = now
-        elim_set = set(elim)
-        prefixes = candidates - elim_set
-        for c in prefixes:
-            reduced = root.deepcopy()
-            for e in prefixes - set((c,)):
-                reduced.eliminate(e)
-            new_elim = [c] + elim
+        heapq.heappush(fringe, (0, -1, 0, False, [c]))
+    batch_size = 1
+    if jobs != 1:
+        batch_size = jobs or multiprocessing.cpu_count()
+    if stats is None:
+        stats = {}
+    stats.clear()
+    stats.update({'hits': 0, 'misses': 0, 'saved': 0.0, 'solved': 0.0, 'build': 0.0,
+                  'pruned': 0, 'prefixes': 0})
+    # The results of _prefix_distance() for the bounded entries whose
+    # programs were solved before they reached the top of the fringe
+    solved = {}
+    pool = None
+    if jobs != 1:
+        pool = multiprocessing.Pool(jobs, _init_margin_worker,
+                                    (root, ranks, cache_dir, solver))
+    try:
+        while True:
+            d, s, t, bound, elim = heapq.heappop(fringe)
+            if trace:
+                print tuple(elim), d, s, t, bound
+            if len(elim) == k and not bound:
+                if trace:
+                    print 'Cache hits %(hits)d (%(saved).2fs saved), misses %(misses)d (%(solved).2fs, %(build).2fs building)' % stats
+                    print 'Prefixes %(prefixes)d, pruned by bound %(pruned)d' % stats
+                return d
+            now = time.time()
+            timeout -= now - then
+            if timeout <= 0.0:
+                return -1
+            then = now
+            if not bound:
+                prefixes = candidates - set(elim)
+                lbs = _prefix_lbs(ballots, elim, prefixes)
+                for c in prefixes:
+                    new_elim = [c] + elim
+                    stats['prefixes'] += 1
+                    lb = max(d, lbs[c])
+                    if trace:
+                        print '\t', tuple(new_elim), lb,
+                    if lb > ub:
+                        stats['pruned'] += 1
+                        if trace:
+                            print
+                        continue
+                    s = -len(new_elim)
+                    t = len(set(new_elim) - tertiary[len(new_elim)-1])
+                    if trace:
+                        print s, t
+                    heapq.heappush(fringe, (lb, s, t, True, new_elim))
+                continue
+            # Solve the programs of the best bounded entries together, one
+            # for each worker. A distance is only used once its entry reaches
+            # the top of the fringe, so the fringe is built exactly as it is
+            # without workers.
+            key = tuple(elim)
+            if key not in solved:
+                batch = [elim]
+                for entry in heapq.nsmallest(batch_size, fringe):
+                    if len(batch) < batch_size and entry[3] \
+                            and tuple(entry[4]) not in solved:
+                        batch.append(entry[4])
+                args = [(candidates - set(e), e, timeout) for e in batch]
+                if pool is None:
+                    distances = [_prefix_distance(root, ranks, cache_dir, solver, *a)
+                                 for a in args]
+                else:
+                    distances = pool.map(_prefix_distance_job, args)
+                for e, result in itertools.izip(batch, distances):
+                    solved[tuple(e)] = result
+            d, hit, seconds, build = solved.pop(key)
+            if hit:
+                stats['hits'] += 1
+                stats['saved'] += seconds
+            else:
+                stats['misses'] += 1
+                stats['solved'] += seconds
+                stats['build'] += build
             if trace:
-                print '\t', tuple(new_elim),
-                sys.stdout.flush()
-            d = ilp.distance_to(reduced, ranks, new_elim, timeout)
+                print '\t', tuple(elim), d
             if d == -1:
                 return -1
             if d <= ub:
-                s = -len(new_elim)
-                t = len(set(new_elim) - tertiary[len(new_elim)-1])
-                if trace:
-                    print d, s, t
-                heapq.heappush(fringe, (d, s, t, new_elim))
-            elif trace:
-                print d
+                heapq.heappush(fringe, (d, s, t, False, elim))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def _prefix_lbs(ballots, elim, prefixes):
+    '''Return lower bounds on the distances to the elimination orders made by
+    putting each candidate in prefixes in front of elim.
+
+    In the first round of C{[c] + elim}, C{c} must have no more votes than
+    any candidate in C{elim}, and the candidates in C{prefixes} other than
+    C{c} have already been eliminated. Adding or removing a ballot changes
+    the votes of at most one candidate by one, so the distance is at least
+    the excess of C{c} over the candidate in C{elim} with the fewest votes.
+    The later rounds are the rounds of C{elim}, so the distance to C{elim}
+    bounds them.
+
+    @type  ballots: list
+    @param ballots: The C{(ballot, weight)} pairs from L{flatten}.
+    @type  elim: list
+    @param elim: The elimination order.
+    @type  prefixes: set
+    @param prefixes: The candidates not in C{elim}.
+    @rtype: dict
+    @return: Returns a mapping from each candidate in C{prefixes} to the
+    lower bound.
+    '''
+    continuing = set(elim)
+    votes = dict.fromkeys(elim, 0)
+    # The votes each candidate in prefixes would get, and would take from
+    # each candidate in elim, if it were the only one of them continuing
+    gained = dict.fromkeys(prefixes, 0)
+    taken = dict((c, dict.fromkeys(elim, 0)) for c in prefixes)
+    for ballot, weight in ballots:
+        before = []
+        for c in ballot:
+            if c in continuing:
+                votes[c] += weight
+                for p in before:
+                    taken[p][c] += weight
+                break
+            before.append(c)
+        for p in before:
+            gained[p] += weight
+    lbs = {}
+    for c in prefixes:
+        t = taken[c]
+        lbs[c] = gained[c] - min(votes[x] - t[x] for x in elim)
+    return lbs
+
+def _prefix_distance(root, ranks, cache_dir, solver, prefix, elim, timeout):
+    '''Eliminate the candidates in prefix and compute the distance to elim.
+
+    The distance is looked up in the cache first and added to it if it had to
+    be computed.
+
+    @type  root: L{Node}
+    @param root: The root of the ballot tree.
+    @type  ranks: number
+    @param ranks: The maximum number of candidates a voter can rank.
+    @type  cache_dir: string
+    @param cache_dir: The cache directory. If C{None}, use L{cache.CACHE_DIR}.
+    @type  solver: string
+    @param solver: The optimization library, see L{ilp.solver_module}.
+    @type  prefix: set
+    @param prefix: The candidates to eliminate first.
+    @type  elim: list
+    @param elim: The elimination order of the remaining candidates.
+    @type  timeout: number
+    @param timeout: The computation timeout.
+    @rtype: number, boolean, number, number
+    @return: Returns the distance, or -1 on timeout, whether it was found in
+    the cache, the solver time in seconds it took to compute, and the part of
+    that time spent building the integer-linear program.
+    '''
+    reduced = root.fork()
+    reduced.eliminate_set(prefix)
+    reduced.reduce(elim)
+    key = cache.distance_key(reduced, ranks, elim)
+    found = cache.get_distance(key, timeout, cache_dir)
+    if found is not None:
+        return found[0], True, found[1], 0.0
+    session = ilp.session(solver)
+    build_time = session.build_time
+    then = time.time()
+    d = session.distance_to(reduced, ranks, elim, timeout)
+    seconds = time.time() - then
+    cache.put_distance(key, d, seconds, timeout, cache_dir)
+    return d, False, seconds, session.build_time - build_time
+
+# The profile, ranks, cache directory and solver of the irv_margin() worker
+# processes
+_margin_root = None
+_margin_ranks = None
+_margin_cache_dir = None
+_margin_solver = None
+
+def _init_margin_worker(root, ranks, cache_dir, solver):
+    '''Initialize an L{irv_margin} worker process.
+
+    The workers are forked, so the profile is inherited rather than sent to
+    each of them. A solver created by the parent must not be shared with the
+    workers, so each worker creates its own.
+    '''
+    global _margin_root, _margin_ranks, _margin_cache_dir, _margin_solver
+    _margin_root = root
+    _margin_ranks = ranks
+    _margin_cache_dir = cache_dir
+    _margin_solver = solver
+    ilp.reset()
+
+def _prefix_distance_job(args):
+    '''Compute L{_prefix_distance} in an L{irv_margin} worker process.'''
+    return _prefix_distance(_margin_root, _margin_ranks, _margin_cache_dir,
+                            _margin_solver, *args)
 
 def irv_lb(election, eliminations=None, trace=False):
     '''Compute and return an IRV margin lower bound and the optimal sequence of
     eliminations that gives it.
 
+    The search is over sets of continuing candidates. Each state keeps its
+    own profile until it is expanded, made with L{Node.fork}, so the states
+    share every node that their eliminations did not change. This is faster
+    than rebuilding each popped state on a single tree and undoing its
+    eliminations afterwards.
+
     @type  election: L{Election}
     @param election: The election.
     @type  eliminations: list
     @param eliminations: If not C{None}, it is set to the optimal sequence of
-    eliminations that gives the lower bound.
+    eliminations that gives the lower bound. Of the sequences that give it,
+    this is the first when they are compared set by set, a set coming before
+    the sets that contain it.
     @type  trace: boolean
     @param trace: If C{True}, then print out at trace of the computation.
     @rtype: number
     @return: Returns the lower bound.
     '''
     root = election.profile
+    # A state is the set of continuing candidates, as a bitmask. Every
+    # sequence of eliminations that reaches a state leaves the same reduced
+    # profile, so each state is reduced and its elimination sets found only
+    # once. The heap pops the entries in increasing order of the negated
+    # bound and then of the eliminations, compared set by set; the sets at
+    # the first difference are both elimination sets of the same state, so
+    # one contains the other. The result is the first sequence in that
+    # order. The entries of a state are popped with decreasing bounds, so an
+    # entry whose eliminations come after those the state was already
+    # expanded with can only lead to later sequences and is skipped.
+    start = _candidate_mask(root.children())
+    # The profile of each state that has not been expanded
+    profiles = {start: root}
+    # The elimination sets, bounds and next states of each expanded state
+    expansions = {}
+    # The first eliminations with which each state was expanded
+    expanded = {}
     # We want a max heap, Python uses a min heap, be careful
-    wl = [(-sys.maxint, [], root)]
+    wl = [(-sys.maxint, [], start)]
     while True:
-        m, s, root = heapq.heappop(wl)
+        m, s, state = heapq.heappop(wl)
         m = -m
+        if state in expanded and expanded[state] < s:
+            continue
         if trace:
             print 'Examining %d' % m
-        if root.num_children() == 1:
-            if trace:
-                print 'Found lb %d' % m
-            if eliminations is not None:
-                del eliminations[:]
-                eliminations.extend(s)
-            return m
-        elim_sets = []
-        _elimination_set(root, rules=SF_RCV_RULES, all_sets=elim_sets)
-        for elim_set in elim_sets:
-            new_root = root.deepcopy()
-            continuing = new_root.children() - elim_set
-            m2 = min(new_root.get_child(c).value for c in continuing) \
-                     - sum(new_root.get_child(c).value for c in elim_set)
-            for c in elim_set:
-                new_root.eliminate(c)
-            if trace:
-                print 'Pushing %d' % min(m, m2)
+        if state not in expansions:
+            root = profiles.pop(state)
+            if root.num_children() == 1:
+                if trace:
+                    print 'Found lb %d' % m
+                if eliminations is not None:
+                    del eliminations[:]
+                    eliminations.extend(s)
+                return m
+            elim_sets = []
+            _elimination_set(root, rules=SF_RCV_RULES, all_sets=elim_sets)
+            expansion = []
+            for elim_set in elim_sets:
+                continuing = root.children() - elim_set
+                m2 = min(root.get_child(c).value for c in continuing) \
+                     - sum(root.get_child(c).value for c in elim_set)
+                state2 = _candidate_mask(continuing)
+                if state2 not in profiles and state2 not in expansions:
+                    new_root = root.fork()
+                    new_root.eliminate_set(elim_set)
+                    profiles[state2] = new_root
+                expansion.append((elim_set, m2, state2))
+            expansions[state] = expansion
+        expanded[state] = s
+        for elim_set, m2, state2 in expansions[state]:
+            m2 = min(m, m2)
             s2 = list(s)
             s2.append(elim_set)
-            heapq.heappush(wl, (-min(m, m2), s2, new_root))
+            if state2 in expanded and expanded[state2] < s2:
+                continue
+            if trace:
+                print 'Pushing %d' % m2
+            heapq.heappush(wl, (-m2, s2, state2))
+
+def _candidate_mask(candidates):
+    '''Return the bitmask of a set of candidates.
+
+    @type  candidates: iterable
+    @param candidates: The candidates.
+    @rtype: number
+    @return: Returns the sum of 2**c for each candidate c.
+    '''
+    mask = 0
+    for c in candidates:
+        mask |= 1 << c
+    return mask
 
 # Margin m, old loser j, new loser k, winner w
 # This changes the margin by more than m.
-def _modify_margin(root, m, j, k, elim_order, w, trace):
+def _modify_margin(tally, m, j, k, elim_order, w, trace):
     '''Modify the round-margin by more than m.
 
-    @type  root: L{Node}
-    @param root: The root of the ballot tree.
+    @type  tally: L{Tally}
+    @param tally: The tally of the continuing candidates. The shifted votes
+    are moved in it.
     @type  m: number
     @param m: The current margin (more or less).
     @type  j: number
@@ -391,40 +714,93 @@ def _modify_margin(root, m, j, k, elim_order, w, trace):
     steal_from_order.extend(elim_order[0] - set((j,)))
     steal_from_order.append(j)
     steal_from_order.remove(k)
+    rank = dict((c, i) for i, c in enumerate(steal_from_order))
+    last = len(rank)
+
+    # Steal the votes from the ballots for k in the order of a depth-first
+    # walk of their tree that tries the next candidates in steal_from_order
+    # and takes the ballots ending at a node after the ones continuing past
+    # it.
+    def _key(entry):
+        '''The position of a ballot in the walk'''
+        return [rank[c] for c in entry[1][1:]] + [last]
+    pile = sorted(tally.pile(k), key=_key)
+    changed = 0
+    for ballot, group in itertools.groupby(pile, key=lambda entry: entry[1]):
+        group = list(group)
+        x = min(sum(num for _, _, num in group), math.floor(m/2)+1)
+        m -= 2*x
+        changed += x
+        if trace:
+            print 'shifting %d from %s to %d' % (x, str(list(ballot)), j)
+        for b, _, num in group:
+            num = min(num, x)
+            tally.remove(b, num)
+            x -= num
+            if x == 0:
+                break
+        if m < 0:
+            break
+    tally.add((j,), changed)
+    return changed
 
-    def _steal_votes(node, m, path):
-        '''Steal at least m votes'''
-        changed = 0
-        # Try children
-        for c in steal_from_order:
-            if node.has_child(c):
-                child = node.get_child(c)
-                path.append(c)
-                subtotal, m = _steal_votes(child, m, path)
-                path.pop()
-                assert child.value >= 0
-                changed += subtotal
-                node.value -= subtotal
-                if child.value == 0:
-                    node.delete_child(c)
-                if m < 0:
-                    return (changed, m)
-        # Try self
-        if node.value > 0:
-            x = min(node.value, math.floor(m/2)+1)
-            assert x > 0
-            node.value -= x
-            root.get_child(j).value += x
-            m -= 2*x
-            changed += x
-            if trace:
-                print 'shifting %d from %s to %d' % (x, str(path), j)
-        return (changed, m)
-    return _steal_votes(root.get_child(k), m, [k])[0]
+def _tally_rounds(tally, rounds, rules, keep=None):
+    '''Perform at most rounds rounds of IRV on a tally, as L{irv_round} does on
+    a tree.
+
+    @type  tally: L{Tally}
+    @param tally: The tally. The eliminated candidates are removed from it.
+    @type  rounds: number
+    @param rounds: The maximum number of rounds to perform.
+    @type  rules: enum
+    @param rules: The IRV rules to use for elimination.
+    @type  keep: number
+    @param keep: If not C{None}, a candidate whose elimination round is
+    wanted.
+    @rtype: number, list, L{Tally}
+    @return: Returns the winner, if any, the list of elimination sets used,
+    and the tally before the round in which C{keep} is eliminated, or
+    C{None}. The latter is C{tally} itself if no candidate is eliminated
+    after that round.
+    '''
+    winner = None
+    elimination = []
+    kept = None
+    r = 0
+    while r < rounds:
+        r += 1
+        votes = list(tally.iteritems())
+        num_votes = 0
+        high_candidate = 0
+        high_votes = 0
+        for c, v in votes:
+            num_votes += v
+            if v > high_votes:
+                high_candidate = c
+                high_votes = v
+
+        # Check if the candidate with the most votes has a majority
+        if rules != COMPLETE_IRV_RULES and high_votes*2 > num_votes \
+                or len(tally) <= 2:
+            winner = high_candidate
+            final_elim = tally.candidates()
+            final_elim.remove(winner)
+            elimination.append(final_elim)
+            if keep in final_elim:
+                kept = tally
+            break
+
+        lowest = _votes_elimination_set(votes, rules)
+        if keep in lowest:
+            kept = tally.copy()
+        tally.eliminate_set(lowest)
+        elimination.append(lowest)
+    return (winner, elimination, kept)
 
 # Using the SF RCV rules cannot increase the upper bound; however, if the 
 # base IRV rules are wanted, they can be used.
-def irv_ub(election, rules=SF_RCV_RULES, winner=None, elim_order=None, trace=False):
+def irv_ub(election, rules=SF_RCV_RULES, winner=None, elim_order=None, trace=False,
+           jobs=1, errors=None):
     '''Compute and return an IRV margin upper bound.
 
     @type  election: L{Election}
@@ -433,51 +809,129 @@ def irv_ub(election, rules=SF_RCV_RULES, winner=None, elim_order=None, trace=Fal
     @param rules: The rules to use. Should probably not be changed.
     @type  trace: boolean
     @param trace: If C{True}, then print a trace of the computation.
+    @type  jobs: number
+    @param jobs: The number of worker processes, each computing the error
+    for some of the losers. If C{None}, use one per CPU. The bound is the
+    same for any number of workers.
+    @type  errors: dict
+    @param errors: If not C{None}, it is cleared and filled with the number
+    of ballots changed to make each loser win.
     @rtype: number
     @return: Returns an upper bound on the margin.
     '''
-    root = election.profile
-    candidates = root.children()
-    error = dict()
+    base = Tally(election.profile)
+    candidates = base.candidates()
 
     if winner is None or elim_order is None:
         winner, _, elim_order = irv(election, rules=rules)
-    for j in candidates:
-        if j == winner:
-            continue
-        new_root = root.deepcopy()
-        w = winner
-        mod_elim_order = elim_order
-        error[j] = 0
-        while w == winner:
-            l = 0
-            while j not in mod_elim_order[l]:
-                l += 1
-            if l > 0:
-                _, _, _, new_root = irv_round(new_root, l, rules=rules)
-            # Since j was eliminated in round l (starting with round 0), for j
-            # to not be eliminated, j needs more votes than everyone else who
-            # was eliminated in round l and the sum of the votes for those
-            # eliminated in round l must be at least the number of votes of
-            # one candidate not eliminated in round l.
-
-            votes_for_j = new_root.get_child(j).value
-            diff = sys.maxint
-            for c in new_root.children() - mod_elim_order[l]:
-                d = new_root.get_child(c).value - votes_for_j
-                if d < diff:
-                    k = c
-                    diff = d
-            assert diff < sys.maxint
-            s = sum( new_root.get_child(c).value for c in mod_elim_order[l] )
-            m = new_root.get_child(k).value - s
-            if s > votes_for_j:
-                m -= 1
-            assert m >= 0
-            error[j] += _modify_margin(new_root, m, j, k, mod_elim_order[l:], w, trace)
-            w, _, mod_elim_order, _ = irv_round(new_root, new_root.num_children(), rules=rules)
-        if trace:
-            print 'error[%d] = %d' % (j, error[j])
-    return 2*min(error.values())
+    losers = sorted(candidates - set((winner,)))
+    if jobs == 1:
+        error = [_loser_error(base, j, winner, elim_order, rules, trace)
+                 for j in losers]
+    else:
+        pool = multiprocessing.Pool(jobs, _init_ub_worker,
+                                    (base, winner, elim_order, rules, trace))
+        try:
+            error = pool.map(_loser_error_job, losers)
+        finally:
+            pool.terminate()
+            pool.join()
+    if errors is None:
+        errors = {}
+    errors.clear()
+    errors.update(itertools.izip(losers, error))
+    return 2*min(error)
+
+def _loser_error(base, j, winner, elim_order, rules, trace):
+    '''Compute the number of ballots L{irv_ub} changes to make j win.
+
+    @type  base: L{Tally}
+    @param base: The tally of the first-choice votes. It is not modified.
+    @type  j: number
+    @param j: The loser.
+    @type  winner: number
+    @param winner: The winner of the election.
+    @type  elim_order: list
+    @param elim_order: The elimination order.
+    @type  rules: enum
+    @param rules: The rules to use.
+    @type  trace: boolean
+    @param trace: If C{True}, then print a trace of the computation.
+    @rtype: number
+    @return: Returns the number of ballots changed.
+    '''
+    w = winner
+    mod_elim_order = elim_order
+    l = 0
+    while j not in mod_elim_order[l]:
+        l += 1
+    reduced = base.copy()
+    _tally_rounds(reduced, l, rules)
+    error = 0
+    while True:
+        # Since j was eliminated in round l (starting with round 0), for j
+        # to not be eliminated, j needs more votes than everyone else who
+        # was eliminated in round l and the sum of the votes for those
+        # eliminated in round l must be at least the number of votes of
+        # one candidate not eliminated in round l.
+
+        # If elim_order was not computed with rules, some of the candidates
+        # of round l may already have been eliminated. They come back with
+        # no votes, as they did when the tree created them as children.
+        for c in mod_elim_order[l]:
+            if c not in reduced.candidates():
+                reduced.restore(c)
+        votes_for_j = reduced.value(j)
+        diff = sys.maxint
+        for c in reduced.candidates() - mod_elim_order[l]:
+            d = reduced.value(c) - votes_for_j
+            if d < diff:
+                k = c
+                diff = d
+        assert diff < sys.maxint
+        s = sum( reduced.value(c) for c in mod_elim_order[l] )
+        m = reduced.value(k) - s
+        if s > votes_for_j:
+            m -= 1
+        assert m >= 0
+        error += _modify_margin(reduced, m, j, k, mod_elim_order[l:], w, trace)
+        # Only the ballots moved to j changed, so finish the count from the
+        # modified tally and keep it as it is before the round eliminating j,
+        # which is where the next pass starts.
+        w, mod_elim_order, reduced = _tally_rounds(reduced, len(reduced), rules, j)
+        if w != winner:
+            break
+        l = 0
+        while j not in mod_elim_order[l]:
+            l += 1
+    if trace:
+        print 'error[%d] = %d' % (j, error)
+    return error
+
+# The first-choice tally, winner, elimination order, rules and trace flag of
+# the irv_ub() worker processes
+_ub_base = None
+_ub_winner = None
+_ub_elim_order = None
+_ub_rules = None
+_ub_trace = False
+
+def _init_ub_worker(base, winner, elim_order, rules, trace):
+    '''Initialize an L{irv_ub} worker process.
+
+    The workers are forked, so the tally is inherited rather than sent with
+    each loser.
+    '''
+    global _ub_base, _ub_winner, _ub_elim_order, _ub_rules, _ub_trace
+    _ub_base = base
+    _ub_winner = winner
+    _ub_elim_order = elim_order
+    _ub_rules = rules
+    _ub_trace = trace
+
+def _loser_error_job(j):
+    '''Compute L{_loser_error} in an L{irv_ub} worker process.'''
+    return _loser_error(_ub_base, j, _ub_winner, _ub_elim_order, _ub_rules,
+                        _ub_trace)
 
 # vim: set sw=4 sts=4 tw=0 expandtab:
@@ -28,16 +28,33 @@ modify ballots in an IRV election.
 '''
 
 import copy
+import hashlib
 
 class Node(object):
     '''A basic tree node with a value and children and IRV-specific methods.
+
+    Trees can share subtrees. L{fork} returns a copy-on-write copy of a tree
+    in constant time and the methods that modify the tree copy shared nodes
+    only along the paths they change. For this to work, nodes must only be
+    modified through the root of their tree or through nodes returned by
+    L{get_child}; the nodes returned by L{iterchildren} may be shared and are
+    read-only.
     
     @type value: number
     @ivar value: The value of the node, including the sum of the values of 
     its children.
     @type _children: dict
     @ivar _children: The node's children.
+    @type _shared: boolean
+    @ivar _shared: C{True} if the node may be part of more than one tree, in
+    which case it must be copied before it is modified. So must all of the
+    nodes below it.
+    @type _fingerprint: string
+    @ivar _fingerprint: The cached L{fingerprint} of a shared node or C{None}.
     '''
+    # Only nodes that are shared need their own attributes
+    _shared = False
+    _fingerprint = None
 
     def __init__(self, value=0, children=None):
         '''Create a new node with an optional value and children nodes.
@@ -73,16 +90,23 @@ class Node(object):
 
     def get_child(self, c):
         '''Return the child node, creating it first, if necessary.
+
+        If the child is shared with another tree, it is replaced by a copy
+        first so that the node returned can be modified.
         
         @type  c: number
         @param c: The child.
         @rtype: L{Node}
         @return: Returns the child node.
         '''
-        if c not in self._children:
-            n = Node()
-            self._children[c] = n
-        return self._children[c]
+        node = self._children.get(c)
+        if node is None:
+            node = Node()
+            self._children[c] = node
+        elif node._shared:
+            node = node._clone()
+            self._children[c] = node
+        return node
 
     def delete_child(self, c):
         '''Delete the child.
@@ -98,31 +122,125 @@ class Node(object):
         @type  c: number
         @param c: The child.
         '''
-        if c in self._children:
-            child = self._children[c]
-            del self._children[c]
-            # pylint: disable=W0212
-            for name, node in child._children.iteritems():
-                self.get_child(name)._merge(node)
-            # pylint: enable=W0212
-        for _, node in self._children.iteritems():
-            node.eliminate(c)
+        self.eliminate_set((c,))
 
-    def _merge(self, n):
-        '''Merge a node into self by adding the value and merging children.
+    def eliminate_set(self, cands):
+        '''Eliminate all of the candidates in cands in one pass over the tree.
 
-        @type  n: L{Node}
-        @param n: The node to merge in.
+        This gives the same tree as calling L{eliminate} for each candidate in
+        turn, but each node is visited once and the traversal is iterative, so
+        it is not limited by the recursion limit.
+
+        @type  cands: iterable
+        @param cands: The candidates to eliminate.
         '''
-        self.value += n.value
+        cands = frozenset(cands)
+        if not cands:
+            return
+        assert not self._shared, 'Cannot modify a shared node'
         # pylint: disable=W0212
-        if not self._children:
-            self._children = n._children
-        else:
-            for name, node in n._children.iteritems():
-                self.get_child(name)._merge(node)
+        self._splice(cands, False)
+        # Each frame holds the node as it was found in its parent, the node
+        # itself or its copy, whether the node is in a shared subtree, the
+        # children left to visit, and the name of the node in its parent.
+        stack = [[self, self, False, self._children.items(), None]]
+        while stack:
+            frame = stack[-1]
+            pending = frame[3]
+            while pending:
+                name, child = pending.pop()
+                if not child._children:
+                    continue
+                # If node is a copy, its children are marked as shared.
+                child_shared = (frame[2] and frame[1] is frame[0]) or \
+                        child._shared
+                if cands.isdisjoint(child._children):
+                    new_child = child
+                else:
+                    new_child = child._splice(cands, child_shared)
+                stack.append([child, new_child, child_shared,
+                              new_child._children.items(), name])
+                break
+            else:
+                stack.pop()
+                orig, node = frame[0], frame[1]
+                if node is not orig:
+                    parent = stack[-1]
+                    if parent[1] is parent[0] and parent[2]:
+                        parent[1] = parent[0]._clone()
+                    parent[1]._children[frame[4]] = node
         # pylint: enable=W0212
 
+    def _splice(self, cands, shared):
+        '''Remove the children in cands and merge their children with self's.
+
+        If the node is shared, the node is copied first and the copy is
+        modified instead.
+
+        @type  cands: frozenset
+        @param cands: The candidates to eliminate.
+        @type  shared: boolean
+        @param shared: C{True} if the node or one of its ancestors is shared.
+        @rtype: L{Node}
+        @return: Returns the node or its copy.
+        '''
+        node = self
+        while True:
+            found = [c for c in cands if c in node._children]
+            if not found:
+                return node
+            if shared and node is self:
+                node = self._clone()
+            for c in found:
+                # pylint: disable=W0212
+                child = node._children.pop(c)
+                for name, grandchild in child._children.iteritems():
+                    node.get_child(name)._merge(grandchild, child._shared)
+                # pylint: enable=W0212
+
+    def _merge(self, n, shared):
+        '''Merge a node into self by adding the value and merging children.
+
+        @type  n: L{Node}
+        @param n: The node to merge in. If it is not shared, self takes over
+        its children.
+        @type  shared: boolean
+        @param shared: C{True} if an ancestor of n is shared.
+        '''
+        stack = [(self, n, shared)]
+        while stack:
+            dst, src, shared = stack.pop()
+            shared = shared or src._shared
+            dst.value += src.value
+            # pylint: disable=W0212
+            if not dst._children:
+                if shared:
+                    dst._children = src._share_children()
+                else:
+                    dst._children = src._children
+            else:
+                for name, node in src._children.iteritems():
+                    stack.append((dst.get_child(name), node, shared))
+            # pylint: enable=W0212
+
+    def _share_children(self):
+        '''Mark the children as shared and return a copy of the dictionary.
+
+        @rtype: dict
+        @return: Returns a new dictionary with the same children.
+        '''
+        for node in self._children.itervalues():
+            node._shared = True
+        return dict(self._children)
+
+    def _clone(self):
+        '''Return an unshared copy of the node which shares its children.
+
+        @rtype: L{Node}
+        @return: Returns the copy.
+        '''
+        return Node(value=self.value, children=self._share_children())
+
     def reduce(self, elim_order):
         '''Reduce the ballot tree modulo an elimination order.
 
@@ -132,31 +250,44 @@ class Node(object):
         preceeds C{j} in C{elim_order} and there is a ballot in which C{j}
         preceeds C{i}, then C{i} can be removed from the ballot completely.
 
+        The reduced tree is built in a single traversal of the tree: a
+        candidate is kept on a ballot only if it is eliminated after every
+        candidate kept ahead of it, and nothing after one of the two final
+        round candidates is kept.
+
         @type  elim_order: list
         @param elim_order: The elimination order.
         '''
         assert len(elim_order) == len(self._children)
         if len(elim_order) < 2:
             return
-        for c, node in self._children.iteritems():
-            # pylint: disable=W0212
-            node._reduce(c, elim_order, 0)
-            # pylint: enable=W0212
-
-    def _reduce(self, c, elim_order, start):
-        '''Reduce the ballot tree modulo an elimination order.'''
-        # If the final round candidates appear, nothing farther down the ballot matters
-        if c == elim_order[-1] or c == elim_order[-2]:
-            self._children.clear()
-            return
-        idx = elim_order.index(c)
-        for i in range(start, idx):
-            self.eliminate(elim_order[i])
-        start += 1
-        for c, node in self._children.iteritems():
+        position = dict((c, i) for i, c in enumerate(elim_order))
+        final = len(elim_order) - 2
+        children = {}
+        # Each entry is a node of the original tree, the children of the node
+        # of the reduced tree that it maps to, and the position in elim_order
+        # of the last candidate kept on the path to it.
+        stack = [(self, children, -1)]
+        while stack:
+            node, reduced, last = stack.pop()
             # pylint: disable=W0212
-            node._reduce(c, elim_order, start)
+            for c, child in node._children.iteritems():
+                p = position[c]
+                if p < last:
+                    # Drop c from the ballots
+                    stack.append((child, reduced, last))
+                    continue
+                new_child = reduced.get(c)
+                if new_child is None:
+                    new_child = Node()
+                    reduced[c] = new_child
+                new_child.value += child.value
+                # If the final round candidates appear, nothing farther down
+                # the ballot matters
+                if p < final:
+                    stack.append((child, new_child._children, p))
             # pylint: enable=W0212
+        self._children = children
 
     def children(self):
         '''Return a set of children names.
@@ -203,12 +334,116 @@ class Node(object):
 
     def __deepcopy__(self, memo):
         '''Return a deep copy of the node.
+
+        Nodes shared by a hash-consed tree are copied once for each parent,
+        so the copy is an ordinary tree that can be modified in place.
         
         @rtype: L{Node}
         @return: Returns a deep copy.
         '''
-        return Node(value=self.value, children=copy.deepcopy(self._children, memo))
+        return Node(value=self.value,
+                    children=dict((c, copy.deepcopy(n))
+                                  for c, n in self._children.iteritems()))
     
+    def fork(self):
+        '''Return a copy-on-write copy of the tree rooted at the node.
+
+        Only the node itself is copied. The rest of the tree is shared between
+        the copy and the original and a node is only copied when one of the
+        trees is modified below it, so the cost of the copy is proportional to
+        the number of nodes that are subsequently changed.
+
+        @rtype: L{Node}
+        @return: Returns the copy.
+        '''
+        return self._clone()
+
+    def fingerprint(self):
+        '''Return a structural fingerprint of the tree rooted at the node.
+
+        Two trees have the same fingerprint if and only if (barring SHA-1
+        collisions) they have the same values and children, so fingerprints
+        can be used to compare and hash profiles. The fingerprint of a node
+        is computed from the fingerprints of its children and is cached only
+        for shared nodes, which never change. Every call therefore visits all
+        of the nodes that are not shared: for a tree returned by L{hashcons}
+        that is just the root, but for a tree that shares nothing it is the
+        whole tree, every time.
+
+        @rtype: string
+        @return: Returns the fingerprint.
+        '''
+        if self._fingerprint is not None:
+            return self._fingerprint
+        fingerprints = {}
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if node._fingerprint is not None:
+                fingerprints[id(node)] = node._fingerprint
+            elif visited:
+                # pylint: disable=W0212
+                fp = _fingerprint(node.value, ((c, fingerprints[id(child)])
+                                  for c, child in node._children.iteritems()))
+                # pylint: enable=W0212
+                fingerprints[id(node)] = fp
+                if node._shared:
+                    node._fingerprint = fp
+            else:
+                stack.append((node, True))
+                # pylint: disable=W0212
+                stack.extend((child, False) for child in node._children.itervalues())
+                # pylint: enable=W0212
+        return fingerprints[id(self)]
+
+    def hashcons(self, table=None):
+        '''Return a copy of the tree in which equal subtrees are stored once.
+
+        Every subtree of the copy is a shared node (see L{fork}) taken from
+        C{table}, which maps fingerprints to nodes, so structurally equal
+        subtrees are the same object and are never modified in place. Passing
+        the same C{table} for several trees shares subtrees between them as
+        well. The root of the copy is not shared and can be modified like any
+        other root.
+
+        @type  table: dict
+        @param table: Mapping from fingerprints to shared nodes. If C{None}, a
+        new table is used.
+        @rtype: L{Node}
+        @return: Returns the root of the copy.
+        '''
+        if table is None:
+            table = {}
+        canonical = {}
+        stack = [(self, False)]
+        while stack:
+            node, visited = stack.pop()
+            if id(node) in canonical:
+                continue
+            fp = node._fingerprint
+            if fp is not None and table.get(fp) is node:
+                canonical[id(node)] = node
+            elif visited:
+                # pylint: disable=W0212
+                children = dict((c, canonical[id(child)])
+                                for c, child in node._children.iteritems())
+                # pylint: enable=W0212
+                fp = _fingerprint(node.value, ((c, child._fingerprint)
+                                  for c, child in children.iteritems()))
+                shared = table.get(fp)
+                if shared is None:
+                    shared = Node(value=node.value, children=children)
+                    shared._shared = True
+                    shared._fingerprint = fp
+                    table[fp] = shared
+                canonical[id(node)] = shared
+            else:
+                stack.append((node, True))
+                # pylint: disable=W0212
+                stack.extend((child, False) for child in node._children.itervalues())
+                # pylint: enable=W0212
+        return canonical[id(self)]._clone()
+
     def deepcopy(self):
         '''Return a deep copy of the node.
         
@@ -217,4 +452,20 @@ class Node(object):
         '''
         return copy.deepcopy(self)
 
+def _fingerprint(value, children):
+    '''Compute the fingerprint of a node from its value and its children.
+
+    @type  value: number
+    @param value: The value of the node.
+    @type  children: iterable
+    @param children: The candidates and fingerprints of the children.
+    @rtype: string
+    @return: Returns the fingerprint.
+    '''
+    h = hashlib.sha1('%d' % value)
+    for c, fp in sorted(children):
+        h.update(';%d:' % c)
+        h.update(fp)
+    return h.digest()
+
 # vim: set sw=4 sts=4 tw=0 expandtab:
@@ -0,0 +1,273 @@
+# Copyright (c) 2011, Stephen Checkoway <s@cs.ucsd.edu>
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# 
+# - Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# 
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+'''
+This module contains the Tally class, which counts the votes of an IRV
+election by moving ballots between candidates as they are eliminated.
+
+A tree of L{Node}s has to be rebuilt when a candidate is eliminated, which
+touches every node below the candidate. A L{Tally} keeps the distinct
+ballots of the profile in a list and, for each continuing candidate, the
+indices of the ballots on which the candidate is the current top choice.
+Eliminating a candidate moves only the ballots in the candidate's pile to
+their next continuing choice, so the cost of a round is proportional to the
+number of ballots transferred rather than the size of the tree.
+'''
+
+def flatten(profile):
+    '''Return the distinct non-empty ballots of a profile.
+
+    @type  profile: L{Node}
+    @param profile: The root of the profile, either a tree of L{Node}s or a
+    L{CompactProfile}.
+    @rtype: list
+    @return: Returns a list of C{(ballot, weight)} pairs where C{ballot} is a
+    tuple of candidates in order of preference.
+    '''
+    ballots = []
+    # The number of ballots ending at a node is its value minus the values of
+    # its children
+    stack = [(child, (c,)) for c, child in profile.iterchildren()]
+    while stack:
+        node, ballot = stack.pop()
+        num = node.value
+        for c, child in node.iterchildren():
+            num -= child.value
+            stack.append((child, ballot + (c,)))
+        if num > 0:
+            ballots.append((ballot, num))
+    return ballots
+
+class Tally(object):
+    '''The first-choice vote totals of an IRV count in progress.
+
+    @type _ballots: list
+    @ivar _ballots: The distinct ballots, as tuples of candidates.
+    @type _weights: list
+    @ivar _weights: The number of voters casting each ballot.
+    @type _positions: list
+    @ivar _positions: The position in each ballot of its current top choice.
+    @type _piles: dict
+    @ivar _piles: Mapping from each continuing candidate to the list of the
+    ballots on which the candidate is the current top choice.
+    @type _votes: dict
+    @ivar _votes: Mapping from each continuing candidate to the number of
+    votes for the candidate.
+    '''
+    def __init__(self, profile):
+        '''Create a tally of the first-choice votes of a profile.
+
+        @type  profile: L{Node}
+        @param profile: The root of the profile, either a tree of L{Node}s or
+        a L{CompactProfile}. Each child of the root is a candidate.
+        '''
+        object.__init__(self)
+        self._ballots = []
+        self._weights = []
+        self._votes = {}
+        self._piles = {}
+        for c, _ in profile.iterchildren():
+            self._votes[c] = 0
+            self._piles[c] = []
+        for ballot, num in flatten(profile):
+            first = ballot[0]
+            self._piles[first].append(len(self._ballots))
+            self._votes[first] += num
+            self._ballots.append(ballot)
+            self._weights.append(num)
+        self._positions = [0] * len(self._ballots)
+
+    def __len__(self):
+        '''Return the number of continuing candidates.
+
+        @rtype: number
+        @return: Returns the number of continuing candidates.
+        '''
+        return len(self._votes)
+
+    def candidates(self):
+        '''Return the set of continuing candidates.
+
+        @rtype: set
+        @return: Returns the set of continuing candidates.
+        '''
+        return set(self._votes)
+
+    def value(self, c):
+        '''Return the number of votes for a continuing candidate.
+
+        @type  c: number
+        @param c: The candidate.
+        @rtype: number
+        @return: Returns the number of votes for C{c}.
+        '''
+        return self._votes[c]
+
+    def iteritems(self):
+        '''Iterate over the continuing candidates in increasing order and
+        their votes.
+
+        @rtype: iterator
+        @return: Returns an iterator over (candidate, votes) pairs.
+        '''
+        votes = self._votes
+        for c in sorted(votes):
+            yield c, votes[c]
+
+    def copy(self):
+        '''Return a copy of the tally that can be changed independently.
+
+        The ballots themselves are shared, so the cost of the copy is
+        proportional to the number of distinct ballots.
+
+        @rtype: L{Tally}
+        @return: Returns the copy.
+        '''
+        other = Tally.__new__(Tally)
+        other._ballots = list(self._ballots)
+        other._weights = list(self._weights)
+        other._positions = list(self._positions)
+        other._piles = dict((c, list(pile)) for c, pile in self._piles.iteritems())
+        other._votes = dict(self._votes)
+        return other
+
+    def pile(self, c):
+        '''Return the ballots on which a continuing candidate is the current
+        top choice.
+
+        @type  c: number
+        @param c: The candidate.
+        @rtype: list
+        @return: Returns a list of C{(b, ballot, weight)} triples, one for each
+        distinct ballot C{b} cast by a nonzero number of voters, where
+        C{ballot} is the tuple of the continuing candidates on it in order of
+        preference, starting with C{c}.
+        '''
+        votes = self._votes
+        ballots = self._ballots
+        weights = self._weights
+        positions = self._positions
+        result = []
+        for b in self._piles[c]:
+            if weights[b]:
+                ballot = tuple(d for d in ballots[b][positions[b]:] if d in votes)
+                result.append((b, ballot, weights[b]))
+        return result
+
+    def remove(self, b, num):
+        '''Remove voters from a distinct ballot.
+
+        @type  b: number
+        @param b: The distinct ballot, as returned by L{pile}.
+        @type  num: number
+        @param num: The number of voters to remove.
+        '''
+        assert 0 < num <= self._weights[b]
+        self._weights[b] -= num
+        self._votes[self._ballots[b][self._positions[b]]] -= num
+
+    def add(self, ballot, num):
+        '''Add voters casting a ballot.
+
+        @type  ballot: tuple
+        @param ballot: The candidates in order of preference. The first one
+        must be continuing.
+        @type  num: number
+        @param num: The number of voters to add.
+        '''
+        c = ballot[0]
+        self._piles[c].append(len(self._ballots))
+        self._votes[c] += num
+        self._ballots.append(ballot)
+        self._weights.append(num)
+        self._positions.append(0)
+
+    def restore(self, c):
+        '''Make an eliminated candidate continuing again with no votes.
+
+        The candidate is struck from every ballot, as eliminating it from a
+        tree of L{Node}s does, so the candidate only gets the votes added for
+        it with L{add}. This is what L{Node.get_child} does for a candidate
+        that is not a child of the root.
+
+        @type  c: number
+        @param c: The candidate.
+        '''
+        assert c not in self._votes
+        ballots = self._ballots
+        positions = self._positions
+        for b, ballot in enumerate(ballots):
+            if c in ballot:
+                i = ballot.index(c)
+                ballots[b] = ballot[:i] + ballot[i+1:]
+                if i < positions[b]:
+                    positions[b] -= 1
+        self._votes[c] = 0
+        self._piles[c] = []
+
+    def eliminate(self, c):
+        '''Eliminate a candidate and transfer the candidate's ballots.
+
+        @type  c: number
+        @param c: The candidate.
+        @rtype: number
+        @return: Returns the number of distinct ballots transferred.
+        '''
+        return self.eliminate_set((c,))
+
+    def eliminate_set(self, cands):
+        '''Eliminate all of the candidates in cands and transfer each of their
+        ballots to its next continuing choice, if any.
+
+        @type  cands: iterable
+        @param cands: The candidates to eliminate.
+        @rtype: number
+        @return: Returns the number of distinct ballots transferred.
+        '''
+        votes = self._votes
+        piles = self._piles
+        ballots = self._ballots
+        weights = self._weights
+        positions = self._positions
+        pending = []
+        for c in cands:
+            del votes[c]
+            pending.append(piles.pop(c))
+        moved = 0
+        for pile in pending:
+            moved += len(pile)
+            for b in pile:
+                ballot = ballots[b]
+                i = positions[b] + 1
+                n = len(ballot)
+                while i < n and ballot[i] not in votes:
+                    i += 1
+                positions[b] = i
+                if i < n:
+                    c = ballot[i]
+                    piles[c].append(b)
+                    votes[c] += weights[b]
+        return moved
+
+# vim: set sw=4 sts=4 tw=0 expandtab:
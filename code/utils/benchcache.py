@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# Compare the time to load elections from the binary profile cache with the
+# time to load them from pickles.
+#
+# Usage: benchcache.py [election.blt ...]
+
+import cPickle
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elections import blt, cache
+
+REPEAT = 20
+
+def best_time(fn, arg):
+    best = None
+    for _ in range(REPEAT):
+        then = time.time()
+        fn(arg)
+        t = time.time() - then
+        if best is None or t < best:
+            best = t
+    return best
+
+def load_pickle(path):
+    f = open(path, 'rb')
+    election = cPickle.load(f)
+    f.close()
+    return election
+
+paths = sys.argv[1:] or sorted(glob.glob('data/*.blt'))
+tmp = tempfile.mkdtemp()
+try:
+    print '| File | pickle (bytes) | bltc (bytes) | pickle (ms) | bltc (ms) |'
+    print '|------|----------------|--------------|-------------|-----------|'
+    for path in paths:
+        election = blt._read_blt(path)
+        pickled = os.path.join(tmp, 'election.pickle')
+        f = open(pickled, 'wb')
+        cPickle.dump(election, f, -1)
+        f.close()
+        cached = os.path.join(tmp, 'election.bltc')
+        cache.dump(cached, election)
+        print '| %s | %d | %d | %.2f | %.2f |' % (os.path.basename(path),
+                os.path.getsize(pickled), os.path.getsize(cached),
+                1000*best_time(load_pickle, pickled),
+                1000*best_time(cache.load, cached))
+finally:
+    shutil.rmtree(tmp)
+# vim: set sw=4 sts=4 tw=0 expandtab:
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+# Compare the size of .blt files and the time to write, parse, and stream them
+# for each supported compression format.
+#
+# Usage: benchcodecs.py [election.blt ...]
+
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elections import blt
+
+SUFFIXES = ['', '.gz', '.bz2', '.xz']
+if blt.lzma is None:
+    SUFFIXES.remove('.xz')
+
+paths = sys.argv[1:] or sorted(glob.glob('data/*Pierce_County*.blt') +
+                               glob.glob('data/*San_Francisco*.blt'))
+tmp = tempfile.mkdtemp()
+try:
+    print '| File | Codec | Size (bytes) | Write (s) | Read (s) | Stream (s) |'
+    print '|------|-------|--------------|-----------|----------|------------|'
+    for path in paths:
+        try:
+            election = blt._read_blt(path)
+        except AssertionError:
+            # Some files have ballots for undeclared candidates
+            continue
+        for suffix in SUFFIXES:
+            out = os.path.join(tmp, os.path.basename(path) + suffix)
+            then = time.time()
+            blt.write_blt(out, election)
+            write_time = time.time() - then
+            then = time.time()
+            blt._read_blt(out)
+            read_time = time.time() - then
+            then = time.time()
+            for _ in blt.iter_ballots(out):
+                pass
+            stream_time = time.time() - then
+            print '| %s | %s | %d | %.3f | %.3f | %.3f |' % (
+                    os.path.basename(path), suffix[1:] or 'none',
+                    os.path.getsize(out), write_time, read_time, stream_time)
+finally:
+    shutil.rmtree(tmp)
+# vim: set sw=4 sts=4 tw=0 expandtab:
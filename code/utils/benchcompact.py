@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+
+# Compare the memory used by, and the time to traverse, the Node and the
+# CompactProfile representations of each election.
+#
+# Usage: benchcompact.py [election.blt ...]
+
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elections import blt
+from elections.compact import CompactProfile
+
+REPEAT = 10
+
+def node_bytes(node):
+    # pylint: disable=W0212
+    size = sys.getsizeof(node) + sys.getsizeof(node.__dict__) + \
+           sys.getsizeof(node._children)
+    # pylint: enable=W0212
+    return size + sum(node_bytes(n) for _, n in node.iterchildren())
+
+def traverse(node):
+    total = node.value
+    for _, n in node.iterchildren():
+        total += traverse(n)
+    return total
+
+def lookup(root):
+    total = 0
+    for c in root:
+        node = root.get_child(c)
+        for d in node:
+            total += node.get_child(d).value
+    return total
+
+def best_time(fn, arg):
+    best = None
+    for _ in range(REPEAT):
+        then = time.time()
+        fn(arg)
+        t = time.time() - then
+        if best is None or t < best:
+            best = t
+    return best
+
+paths = sys.argv[1:] or sorted(glob.glob('data/*.blt'))
+print '| File | Nodes | Node (bytes) | Compact (bytes) | Node traverse (ms) | Compact traverse (ms) | Node lookup (ms) | Compact lookup (ms) |'
+print '|------|-------|--------------|-----------------|--------------------|-----------------------|------------------|---------------------|'
+for path in paths:
+    try:
+        root = blt._read_blt(path).profile
+    except AssertionError:
+        # Some files have ballots for undeclared candidates
+        continue
+    compact = CompactProfile(root)
+    assert traverse(root) == traverse(compact)
+    assert lookup(root) == lookup(compact)
+    print '| %s | %d | %d | %d | %.3f | %.3f | %.3f | %.3f |' % (
+            os.path.basename(path), len(compact), node_bytes(root),
+            compact.nbytes() + sys.getsizeof(compact),
+            1000*best_time(traverse, root), 1000*best_time(traverse, compact),
+            1000*best_time(lookup, root), 1000*best_time(lookup, compact))
+# vim: set sw=4 sts=4 tw=0 expandtab:
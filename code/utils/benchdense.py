@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Compare IRV on the dense ballot matrix with IRV on the tree of Nodes, on
+# each election and on synthetic profiles of a million ballots.
+#
+# Usage: benchdense.py [election.blt ...]
+
+import glob
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elections import blt, irv
+from elections.dense import build_dense, dense_irv
+from elections.election import Election
+from elections.node import Node
+
+REPEAT = 3
+RULES = irv.SF_RCV_RULES
+
+def best_time(fn, *args):
+    best = None
+    for _ in range(REPEAT):
+        then = time.time()
+        result = fn(*args)
+        t = time.time() - then
+        if best is None or t < best:
+            best = t
+    return best, result
+
+def node_irv(election):
+    root = election.profile
+    return irv.irv_round(root, root.num_children(), rules=RULES)[:3]
+
+def same(a, b):
+    counts = dict((c, list(v)) for c, v in b[1].iteritems())
+    return a[0] == b[0] and a[1] == counts and a[2] == b[2]
+
+def synthetic(num_ballots, k, ranks, seed):
+    # Candidates are ranked by noisy popularity, so the first preferences are
+    # skewed and some ballots rank fewer than ranks candidates
+    rng = numpy.random.RandomState(seed)
+    scores = numpy.linspace(0.5, 0, k) + rng.rand(num_ballots, k)
+    order = numpy.argsort(-scores, axis=1)[:, :ranks] + 1
+    lengths = rng.randint(1, ranks+1, num_ballots)
+    order[numpy.arange(ranks) >= lengths[:, None]] = 0
+    return order.astype(numpy.int8)
+
+def tree(m, k):
+    root = Node()
+    for c in xrange(1, k+1):
+        root.get_child(c)
+    rows, weights = numpy.unique(m, axis=0, return_counts=True)
+    for row, weight in zip(rows, weights):
+        node = root
+        for c in row:
+            if c == 0:
+                break
+            node = node.get_child(int(c))
+            node.value += int(weight)
+    root.value = len(m)
+    return Election(names=dict((c, str(c)) for c in xrange(1, k+1)),
+                    profile=root, ranks=m.shape[1], seats=1, description='')
+
+paths = sys.argv[1:] or sorted(glob.glob('data/*.blt'))
+print '| Profile | Ballots | Rows | Node irv_round (ms) | Tally irv (ms) | Dense irv (ms) |'
+print '|---------|---------|------|---------------------|----------------|----------------|'
+totals = [0.0, 0.0, 0.0]
+for path in paths:
+    try:
+        election = blt._read_blt(path)
+    except AssertionError:
+        # Some files have ballots for undeclared candidates
+        continue
+    k = election.profile.num_children()
+    m, w = build_dense(election)
+    t_node, a = best_time(node_irv, election)
+    t_tally, b = best_time(irv.irv, election, RULES)
+    t_dense, c = best_time(dense_irv, m, w, k, RULES)
+    assert a == b and same(a, c)
+    for i, t in enumerate((t_node, t_tally, t_dense)):
+        totals[i] += t
+    print '| %s | %d | %d | %.2f | %.2f | %.2f |' % (os.path.basename(path),
+            w.sum(), len(m), 1000*t_node, 1000*t_tally, 1000*t_dense)
+print '| Corpus total | | | %.2f | %.2f | %.2f |' % tuple(1000*t for t in totals)
+
+for k, ranks in ((10, 3), (20, 10)):
+    m = synthetic(1000000, k, ranks, k)
+    w = numpy.ones(len(m), numpy.int64)
+    election = tree(m, k)
+    t_node, a = best_time(node_irv, election)
+    t_tally, b = best_time(irv.irv, election, RULES)
+    t_dense, c = best_time(dense_irv, m, w, k, RULES)
+    assert a == b and same(a, c)
+    print '| Synthetic, %d candidates, %d ranks | %d | %d | %.2f | %.2f | %.2f |' % (
+            k, ranks, len(m), len(m), 1000*t_node, 1000*t_tally, 1000*t_dense)
+# vim: set sw=4 sts=4 tw=0 expandtab:
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+
+# Time the assembly of the integer-linear programs used by irv_margin,
+# separately from solving them. For each election, build the layout for every
+# number of candidates and load it into the solver, then compute the bounds
+# and right-hand sides of random elimination orders and update the loaded
+# programs with them. Nothing is solved.
+#
+# Usage: benchilp.py [-n orders] [-s cplex|cbc] [election.blt ...]
+
+import getopt
+import glob
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elections import blt, ilp
+
+opts, args = getopt.getopt(sys.argv[1:], 'n:s:')
+opts = dict(opts)
+orders = int(opts.get('-n', 20))
+module = ilp.solver_module(opts.get('-s'))
+
+paths = args or sorted(glob.glob('data/*.blt'))
+print '| File | Candidates | Layout (s) | Load (s) | Orders | Bounds (s) | Update (s) |'
+print '|------|------------|------------|----------|--------|------------|------------|'
+for path in paths:
+    try:
+        election = blt._read_blt(path)
+    except AssertionError:
+        # Some files have ballots for undeclared candidates
+        continue
+    candidates = sorted(election.names)
+    ranks = election.ranks
+    random.seed(0)
+    layout_time = load_time = bounds_time = update_time = 0.0
+    count = 0
+    for k in range(2, len(candidates)+1):
+        ilp._layouts.clear()
+        then = time.time()
+        lay = ilp.layout(k, ranks)
+        layout_time += time.time() - then
+        then = time.time()
+        state = module.load(lay)
+        load_time += time.time() - then
+        for _ in range(orders):
+            elim = random.sample(candidates, k)
+            root = election.profile.fork()
+            root.eliminate_set(set(candidates) - set(elim))
+            then = time.time()
+            ub, rhs = ilp.bounds(root, elim, lay)
+            bounds_time += time.time() - then
+            then = time.time()
+            module.update(state, ub, rhs)
+            update_time += time.time() - then
+            count += 1
+    print '| %s | %d | %.3f | %.3f | %d | %.3f | %.3f |' % (
+            os.path.basename(path), len(candidates), layout_time, load_time,
+            count, bounds_time, update_time)
+    sys.stdout.flush()
+# vim: set sw=4 sts=4 tw=0 expandtab:
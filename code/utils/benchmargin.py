@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# Compute the exact IRV margin of each election with an empty distance cache
+# and report the time taken, the number of integer-linear programs solved
+# and the time spent building and solving them, and the number of
+# elimination orders discarded by the cheap lower bound.
+# Run it once with each solver to compare them.
+#
+# Usage: benchmargin.py [-t timeout] [-j jobs] [-s cplex|cbc] [election.blt ...]
+
+import getopt
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elections import blt, irv
+
+opts, args = getopt.getopt(sys.argv[1:], 't:j:s:')
+opts = dict(opts)
+timeout = float(opts.get('-t', 60))
+jobs = int(opts.get('-j', 1))
+solver = opts.get('-s')
+
+paths = args or sorted(glob.glob('data/*.blt'))
+print '| File | Margin | Time (s) | Prefixes | Pruned | ILPs solved | Build (s) | Solve (s) |'
+print '|------|--------|----------|----------|--------|-------------|-----------|-----------|'
+for path in paths:
+    try:
+        election = blt._read_blt(path)
+    except AssertionError:
+        # Some files have ballots for undeclared candidates
+        continue
+    cache_dir = tempfile.mkdtemp()
+    stats = {}
+    try:
+        then = time.time()
+        margin = irv.irv_margin(election, timeout=timeout, jobs=jobs,
+                                cache_dir=cache_dir, stats=stats,
+                                solver=solver)
+        t = time.time() - then
+    finally:
+        shutil.rmtree(cache_dir, True)
+    print '| %s | %s | %.2f | %d | %d | %d | %.2f | %.2f |' % (
+            os.path.basename(path), margin, t, stats['prefixes'],
+            stats['pruned'], stats['misses'], stats['build'],
+            stats['solved'] - stats['build'])
+    sys.stdout.flush()
+# vim: set sw=4 sts=4 tw=0 expandtab:
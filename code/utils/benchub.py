@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+# Time irv_ub on each election, best of three runs, and report the bound and
+# the largest number of ballots changed to make a loser win.
+#
+# Usage: benchub.py [-j jobs] [election.blt ...]
+
+import getopt
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from elections import blt, irv
+
+REPEAT = 3
+
+opts, args = getopt.getopt(sys.argv[1:], 'j:')
+opts = dict(opts)
+jobs = int(opts.get('-j', 1))
+
+paths = args or sorted(glob.glob('data/*.blt'))
+print '| File | Losers | Upper bound | Max error | Time (ms) |'
+print '|------|--------|-------------|-----------|-----------|'
+total = 0.0
+for path in paths:
+    try:
+        election = blt._read_blt(path)
+    except AssertionError:
+        # Some files have ballots for undeclared candidates
+        continue
+    best = None
+    for _ in range(REPEAT):
+        errors = {}
+        then = time.time()
+        ub = irv.irv_ub(election, jobs=jobs, errors=errors)
+        t = time.time() - then
+        if best is None or t < best:
+            best = t
+    total += best
+    print '| %s | %d | %d | %d | %.2f |' % (os.path.basename(path),
+            len(errors), ub, max(errors.values()), 1000*best)
+    sys.stdout.flush()
+print '| Corpus total | | | | %.2f |' % (1000*total)
+# vim: set sw=4 sts=4 tw=0 expandtab: